@@ -1,286 +1,83 @@
-from datetime import datetime, timedelta
-import numpy as np
-import csv
-import glob
 import os
-import sys
-import matplotlib.pyplot as plt     
-from tkinter import filedialog, messagebox
-from tkinter import *
-from tkinter import ttk
+import queue
+import threading
+import time
+from aquarius_catalog import plan_sources, scan_headers
+from aquarius_core import (empty_data, fill_empties, ingest_file, station_stats, summary_path,
+        writetocsv, year_grid)
+from aquarius_sources import find_sources
+from aquarius_station import plot
+from aquarius_stats import write_summary
 
-def datetime_range(start, end, delta):
-    """
-    Creates full time series of interest.
-    """
-    
-    current = start
-    while current < end:
-        yield current
-        current += delta
-
-def full_dt_range(wtr_yr):
-    """
-    Uses datetime_range to return a full datetime range list object with 15 minute
-    increments for a specific water year (10/1 to 9/30) determined by the only required argument
-    """
-    dt_range = []
-    
-    ## Water year (10/1 - 9/30) full range- 15 minute increments
-    dts = datetime_range(datetime(wtr_yr -1, 10,1, 0, 0, 0),
-        datetime(wtr_yr, 10, 1, 0, 0, 0),
-        timedelta(minutes = 15))
-    for dt in dts:
-        dt_range.append(dt)
-   
-    return dt_range     
-
-
-def empty_data(dt_range):
-
-    """
-    Accepts only a datetime range list argument returned in full_dt_range and returns
-    a dictionary with a key for each column needed in the SD1 file. Each key value is 
-    an np.array created with a length the same as the full datetime range
-    """
-    dt_range = np.asarray(dt_range)
-    
-    ## Numpy NaN arrays for each param equal in length to the datetime range
-    gageheight_ft = np.full_like(dt_range, np.nan, dtype = np.double)
-    discharge_cfs= np.full_like(dt_range, np.nan, dtype = np.double)
-    precip_in = np.full_like(dt_range, np.nan, dtype = np.double)
-    temp_c = np.full_like(dt_range, np.nan, dtype = np.double)
-    do_mgL = np.full_like(dt_range, np.nan, dtype = np.double)
-    pH_su = np.full_like(dt_range, np.nan, dtype = np.double)
-    conduct_umhos = np.full_like(dt_range, np.nan, dtype = np.double)
-    turb_ntu = np.full_like(dt_range, np.nan, dtype = np.double)
-    velocity = np.full_like(dt_range, np.nan, dtype = np.double)
-    nitrate = np.full_like(dt_range, np.nan, dtype = np.double)
-
-    ## Dictionary for datetime range and empty param arrays
-    empties = { "dt_range" : dt_range, "gageheight_ft" : gageheight_ft, 
-            "discharge_cfs" : discharge_cfs, "precip_in" : precip_in, 
-            "temp_c" : temp_c, "do_mgL" : do_mgL, "pH_su" : pH_su, 
-            "cond_umhos" : conduct_umhos, "turb_ntu" : turb_ntu, 
-            "velocity_ft_s" : velocity, "nitrate_mgL": nitrate} 
-
-    return empties
-
-
-def aq_reader(path):
-
-    """
-    Accepts the filepath argument to an AQUARIUS .csv file and returns a dictionary with desired data
-    """
-    with open(path) as f:
-        
-        timestamps = []
-        values = []
-        
-        ## Reading csv
-        lines = f.readlines() 
-        for line in lines:
-            if not line.startswith(("#", "ISO")):
-                values.append(line.split(",")[2])
-                timestamp =(line.split(",")[1])
-                ## Returning a datetime object from date string
-                timestamps.append(datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S"))
-        if "AQUARIUS" in lines[0]:
-
-            station = lines[0].split("@")[1][:8]
-            print(station)
-            name = lines[3].split(":")[1].split(",")[0].strip()
-            print(name)
-            param = lines[6].split(":")[1].split(",")[0].strip()
-            units = lines[5].split(":")[1].split(",")[0].strip()
-            print("Units : " + units) 
-            
-        else: 
-            print("WRONG FILE OR FORMAT!!!")
-    
-    ## Dictionary for AQUARIUS file
-    data_dict = {"station" : station, "name": name, "param": param, 
-            "timestamps": np.asarray(timestamps), "values": np.asarray(values)}
+## Milliseconds between checks of the worker thread's progress events
+POLL_MS = 100
 
-    return data_dict
 
-
-def fill_empties(gage_dict, data_dict):
+def process_worker(wtr_yr, loc, out, events, cancelled):
 
     """
-    Input arguments are the empty gage_dict created by the empty_data function and the data_dict
-    returned from the aq_reader. Parameter values from the aq_reader data_dict are inserted
-    in place of the np.nan values that exist in the gage_dict and amended gage_dict is returned.
+    Builds the SD1 file on a background thread with the same steps as the command line tool.
+    Progress is reported by putting tuples on the events queue, never by touching widgets:
+    ("files", paths), ("file", path, status), ("step", text), ("done", out), ("failed", message)
+    and ("cancelled",). The cancelled threading.Event is checked between steps. Only the headers
+    are read to plan the parse, so files from a different station than the first file, duplicate
+    exports and exports outside the water year are skipped without reading their data.
     """
+    def stopped():
+        if cancelled.is_set():
+            events.put(("cancelled",))
+        return cancelled.is_set()
+
+    try:
+        dt_range, time_dict = year_grid(wtr_yr)
+        gage_dict = empty_data(dt_range)
+        data_dict = None
+
+        param_files = find_sources(loc)
+        events.put(("files", param_files))
+        catalog = scan_headers(param_files)
+
+        ## Checking gage numbers against the first file with a readable header
+        stations = [entry["station"] for entry in catalog if "error" not in entry]
+        planned, skipped = plan_sources(catalog, dt_range, stations[0] if stations else None)
+        for param_file, reason in skipped:
+            events.put(("file", param_file, "Skipped: " + reason))
+
+        for param_file in planned:
+            if stopped():
+                return
+            events.put(("file", param_file, "Reading"))
+            result = ingest_file(param_file, dt_range)
+
+            if "error" in result:
+                events.put(("file", param_file, "Error: " + result["error"]))
+                continue
+
+            fill_empties(gage_dict, result, verbose = False)
+            data_dict = result
+            events.put(("file", param_file, result["param"] + " processed"))
+
+        if data_dict is None:
+            events.put(("failed", "No AQUARIUS files processed in " + loc))
+            return
+
+        if stopped():
+            return
+        events.put(("step", "Plotting"))
+        gage_dict["stats"] = station_stats(gage_dict)
+        write_summary(summary_path(out), data_dict, wtr_yr, gage_dict["stats"])
+        plot(gage_dict)
+
+        if stopped():
+            return
+        events.put(("step", "Writing " + out))
+        writetocsv(gage_dict, data_dict, time_dict, out)
+
+        events.put(("done", out))
+
+    except Exception as err:
+        events.put(("failed", str(err) or type(err).__name__))
 
-    dt_range = gage_dict["dt_range"]
-    values = data_dict["values"]
-    timestamps = data_dict["timestamps"]
-    vals_perf = []
-        
-    ## Loop that finds matching timestamps and inserts data based upon index 
-    ## in the full datetime range similar to excel VLOOKUP 
-    
-    for i in range(len(dt_range)):
-        vals_perf.append(np.NaN)
-        
-        for j in range(len(timestamps)):
-            if dt_range[i] == timestamps[j]:
-                #print(timestamps[j])
-                vals_perf[i] = values[j]
-                break
-
-    
-    vals_perf = np.asarray(vals_perf).astype(np.float)
-    
-    ## Determining parameter from header information in AQUARIUS file dictionary
-    ## Populating np.nan array as necessary
-
-    if data_dict["param"] == "Precipitation":
-        gage_dict["precip_in"] = vals_perf.astype(np.float)
-
-    if data_dict["param"] == "Gage height":
-        gage_dict["gageheight_ft"] = vals_perf.astype(np.float)
-    
-    if data_dict["param"] == "Discharge":
-        gage_dict["discharge_cfs"] = vals_perf.astype(np.float)
-    
-    if data_dict["param"] == "Temperature":
-        gage_dict["temp_c"] = vals_perf.astype(np.float)
-    
-    if data_dict["param"] == "Dissolved oxygen":
-        gage_dict["do_mgL"] = vals_perf.astype(np.float)
-    
-    if data_dict["param"] == "pH":
-        gage_dict["pH_su"] = vals_perf.astype(np.float)
-    
-    if data_dict["param"] == "Specific cond at 25C":
-        gage_dict["cond_umhos"] = vals_perf.astype(np.float)
-    
-    if data_dict["param"] == "Turbidity":
-        gage_dict["turb_ntu"] = vals_perf.astype(np.float)
-    
-    if data_dict["param"] == "Mean water velocity":
-        gage_dict["velocity_ft_s"] = vals_perf.astype(np.float)
-    
-    if data_dict["param"] == "NO3+NO2":
-        gage_dict["nitrate_mgL"] = vals_perf.astype(np.float)
-    
-    ## Printing desired stats
-
-    print(data_dict["param"] + " Mean : " + str(np.nanmean(vals_perf)))
-    print(data_dict["param"] + " Min : " + str(np.nanmin(vals_perf)))
-    print(data_dict["param"] + " Max : " + str(np.nanmax(vals_perf)))
-    
-    ## Updated dictionary
-    return gage_dict
-
-
-def time_cols(dt_range):
-    """
-    Accepts the datetime range list produced by the full_dt_range function and returns 
-    a dictionary with an np.array for date, time, and minutes as needed for the the SD1 file.
-    """
-    date = []
-    time = []
-    mins = []
-    mins_val = 0
-    for dt in dt_range:
-        date.append(dt.strftime("%m/%d/%y"))
-        time.append(dt.strftime("%H:%M"))
-
-        ## Creating an array filled with 15 min increments
-        mins.append(mins_val)
-        if mins_val < 1425:
-            mins_val += 15
-        else:
-            mins_val = 0
- 
-    for item in date, time, mins:
-        item = np.asarray(item)
-    
-    ## Dictionary for time columns as per SD1 file
-    time_dict= {"date" : date, "time": time, "mins": mins}
-    
-    return time_dict
-
-
-
-def writetocsv(gage_dict, data_dict, time_dict, path):
-    """
-    Writes all data manipulated to a final .csv file. Required arguments include the updated gage_dict
-    with updated parameter data, a single parameter data_dict(any) to populate the station information,
-    the time_dict created in the time_cols function, and a filepath to the desired output file.
-    """
-    with open(path, 'w', newline = "\n") as f:
-        
-        writer = csv.writer(f)
-        
-        ## Header row per SD1 example
-        writer.writerow(["station_num","station_name","station","Date","Time"," Mins","DT", "DT2",
-        "gageheight_ft","discharge_cfs","precip_in", "temp_c", "do_mgL", " pH_su", "conductance_umhos",
-        "turb_ntu", "Velocity", "Nitrate"] )
-        
-        ## Writing data to file
-        for i in range(len(gage_dict["dt_range"])):
-
-            writer.writerow([data_dict["station"], data_dict["name"], data_dict["name"].split(" ")[0],
-                    time_dict["date"][i], time_dict["time"][i], time_dict["mins"][i],
-                    gage_dict["dt_range"][i], "", gage_dict["gageheight_ft"][i], 
-                    gage_dict["discharge_cfs"][i], gage_dict["precip_in"][i], 
-                    gage_dict["temp_c"][i], gage_dict["do_mgL"][i], gage_dict["pH_su"][i],
-                    gage_dict["cond_umhos"][i], gage_dict["turb_ntu"][i],
-                    gage_dict["velocity_ft_s"][i], gage_dict["nitrate_mgL"][i]])
-
-
-
-def plot(gage_dict):
-    """
-    Plots for each parameter
-    """
-    ## Create a directory for figures if not already existing
-    if not "figs" in os.listdir("."):
-        os.mkdir("figs")
-
-    params = ["gageheight_ft", "discharge_cfs", "precip_in", "temp_c", "do_mgL", "pH_su",
-            "cond_umhos", "turb_ntu", "velocity_ft_s", "nitrate_mgL"]
-
-    y_labels = ["Gage height (ft)", "Discharge (cfs)", "Precipitation (in)", "Temperature (deg C)",
-            "Dissolved Oxygen (mg/L)", "pH", "Specific Conductance @ 25 deg C (uS/cm)",
-            "Turbidity (FNU)", "Velocity (ft/s)", "Nitrate (mg/L)"]
-
-    for param in params:
-        for key in gage_dict:
-            ## Matching dict key to appropriate y axis label
-            for i in range(len(params)):
-                if param == params[i]:
-                    y_label = y_labels[i] 
-            if param == key:
-                try:
-                
-                    fig = plt.figure()
-                    ax = fig.add_subplot(111)
-                    ax.plot(gage_dict["dt_range"], gage_dict[param])
-                    plt.xlabel('Date' )
-                    ## Rotating x axis labels
-                    plt.xticks( rotation = 45)
-                    ## Gridlines on
-                    ax.grid(True)
-                    ## Text to include summary stats
-                    ## transform = ax.transAxes places text in relative location
-                    ## with (1,1) as top right corner
-                    ax.text(0.75, 0.8, "Mean: " + str(round(np.nanmean(gage_dict[param]), 2)) + 
-                        "\nMin: " + str(round(np.nanmin(gage_dict[param]),2)) + 
-                        "\nMax: " + str(round(np.nanmax(gage_dict[param]),2)), 
-                        transform = ax.transAxes, bbox = dict(fc = 'white'))
-                    plt.ylabel(y_label)
-                    fig.subplots_adjust(bottom = 0.2)
-                    fig.savefig("figs/" + param + ".png")
-                    plt.close()
-            
-                except:
-                    ## For instances where param values are entirely np.nan vals
-                    print("Unable to plot " + param)
 
 def browse_button():
     """
@@ -305,6 +102,98 @@ def outputfile():
     return out_path
 
 
+def start_processing():
+
+    """
+    Command of the Process Files button. Checks the inputs, clears the file list and starts
+    process_worker on a background thread so the window stays responsive.
+    """
+    if job.get("thread") is not None and job["thread"].is_alive():
+        return
+    try:
+        wtr_yr = int(h20_yr.get())
+    except ValueError:
+        status.set("Water year must be a number - ex. 2018")
+        return
+    if not folder_path.get() or not out_path.get():
+        status.set("Choose an input folder and an output file")
+        return
+
+    file_list.delete(*file_list.get_children())
+    progress["value"] = 0
+    job.update({"events" : queue.Queue(), "cancelled" : threading.Event(), "rows" : {},
+        "files" : 0, "steps" : 0, "start" : time.perf_counter()})
+    job["thread"] = threading.Thread(target = process_worker, args = (wtr_yr, folder_path.get(),
+        out_path.get(), job["events"], job["cancelled"]), daemon = True)
+    job["thread"].start()
+
+    process.config(state = DISABLED)
+    cancel.config(state = NORMAL)
+    status.set("Processing...")
+    root.after(POLL_MS, poll_events)
+
+
+def cancel_processing():
+    """
+    Command of the Cancel button. The worker stops before its next file or step.
+    """
+    if job.get("cancelled") is not None:
+        job["cancelled"].set()
+        status.set("Cancelling after the current step...")
+
+
+def poll_events():
+
+    """
+    Applies the progress events put on the queue by the worker thread to the window, then
+    checks again after POLL_MS milliseconds until the worker has finished. Widgets are only
+    ever changed here, on the tkinter thread.
+    """
+    finished = False
+    while True:
+        try:
+            event = job["events"].get_nowait()
+        except queue.Empty:
+            break
+
+        if event[0] == "files":
+            job["files"] = len(event[1])
+            progress["maximum"] = len(event[1]) + 2
+            for path in event[1]:
+                job["rows"][path] = file_list.insert("", END, values = (os.path.basename(path),
+                    "Waiting"))
+        elif event[0] == "file":
+            row = job["rows"][event[1]]
+            file_list.set(row, "status", event[2])
+            file_list.see(row)
+            if event[2].startswith(("Skipped", "Error")):
+                ## Station mismatches and unreadable files are flagged in the list
+                file_list.item(row, tags = ("error",))
+            if event[2] != "Reading":
+                progress["value"] = progress["value"] + 1
+        elif event[0] == "step":
+            progress["value"] = job["files"] + job["steps"]
+            job["steps"] += 1
+            status.set(event[1] + "...")
+        elif event[0] == "done":
+            progress["value"] = progress["maximum"]
+            status.set("Output written as " + event[1])
+            finished = True
+        elif event[0] == "failed":
+            status.set("Failed: " + event[1])
+            finished = True
+        elif event[0] == "cancelled":
+            status.set("Cancelled")
+            finished = True
+
+    elapsed.set("Elapsed: %.1f s" % (time.perf_counter() - job["start"]))
+    if finished or not job["thread"].is_alive() and job["events"].empty():
+        process.config(state = NORMAL)
+        cancel.config(state = DISABLED)
+    else:
+        root.after(POLL_MS, poll_events)
+
+
 def main():
     pass
    ## tkinter functions misbehaving in main function 
@@ -312,6 +201,11 @@ def main():
 
 if __name__ == "__main__":
 
+    ## tkinter is only loaded when the window is opened, process_worker can be imported without it
+    from tkinter import filedialog, messagebox
+    from tkinter import *
+    from tkinter import ttk
+
     ## Instantiating root widget
     root = Tk()
 
@@ -319,7 +213,7 @@ if __name__ == "__main__":
     root.title("AQUARIUS water year time series")
     menu = Menu(root)
     root.config(menu= menu) 
-    explanation ="Compile data from raw United States Geological Survey (USGS) AQUARIUS .csv files into a single .csv file with ease! The output file will include a complete water year time series in 15 minute intervals for data provided from a given USGS gage, as well as a plot for each. Simply insert the water year, select file path to a folder with AQUARIUS files for the appropriate gage and water year,and provide an output file name in .csv format. Progress reports will appear as files are processed, but require no interaction from the user unless a file entered is not from the correct USGS gage."
+    explanation ="Compile data from raw United States Geological Survey (USGS) AQUARIUS .csv files into a single .csv file with ease! The output file will include a complete water year time series in 15 minute intervals for data provided from a given USGS gage, as well as a plot for each. Simply insert the water year, select file path to a folder with AQUARIUS files for the appropriate gage and water year,and provide an output file name in .csv format. Progress is shown in this window as files are processed and requires no interaction; files that are not from the same USGS gage as the first file are skipped and marked in the file list."
 
     helpmenu = Menu(menu)
     menu.add_cascade(label = "Help", menu = helpmenu)
@@ -333,6 +227,11 @@ if __name__ == "__main__":
     folder_path= StringVar()
     out_path = StringVar()
     h20_yr = StringVar()  
+    status = StringVar()
+    elapsed = StringVar()
+
+    ## State of the running job, shared by the button commands and poll_events
+    job = {}
 
     ## Label for water year prompt
     wy_lbl= Label(root, text = "Input water year: ", font = "12")
@@ -364,62 +263,38 @@ if __name__ == "__main__":
     lbl2.grid(row =3, column = 0)
 
     
-    ## GO Button that begins program
-    process = Button(root, text = "Process Files", command = root.destroy, width = 25)
+    ## GO Button that starts processing on a worker thread
+    process = Button(root, text = "Process Files", command = start_processing, width = 25)
     process.grid(row = 4, rowspan = 2, column = 1)
 
+    ## Cancel button, only active while processing
+    cancel = Button(root, text = "Cancel", command = cancel_processing, width = 12,
+            state = DISABLED)
+    cancel.grid(row = 4, rowspan = 2, column = 2)
+
+    ## Status of each file as it is processed
+    file_list = ttk.Treeview(root, columns = ("file", "status"), show = "headings", height = 10)
+    file_list.heading("file", text = "File")
+    file_list.heading("status", text = "Status")
+    file_list.column("file", width = 380)
+    file_list.column("status", width = 260)
+    file_list.tag_configure("error", foreground = "red")
+    file_list.grid(row = 6, column = 0, columnspan = 3, sticky = EW, padx = 5, pady = 5)
+
+    ## Progress bar over files, plotting and writing
+    progress = ttk.Progressbar(root, orient = HORIZONTAL, mode = "determinate")
+    progress.grid(row = 7, column = 0, columnspan = 3, sticky = EW, padx = 5)
+
+    ## Status and elapsed time labels
+    status_lbl = Label(root, textvariable = status, anchor = W)
+    status_lbl.grid(row = 8, column = 0, columnspan = 2, sticky = EW, padx = 5)
+    elapsed_lbl = Label(root, textvariable = elapsed, anchor = E)
+    elapsed_lbl.grid(row = 8, column = 2, sticky = EW, padx = 5)
+
     ##AQUARIUS logo
     #logo_aq = PhotoImage(file = "aquarius_logo.png")
     #insert_logo_aq = Label(root, image = logo_aq)
     #insert_logo_aq.grid(row = 4, rowspan = 2, column = 0)
    
-    ## tkinter event loop that enables window
+    ## tkinter event loop that enables window, processing runs while it is open
     root.mainloop()
-
-    ## .get method needed to extract value from PY_VAR#
-    loc = str(folder_path.get())
-    wtr_yr = int(h20_yr.get())
-
-    time_dict = time_cols(full_dt_range(wtr_yr))
-    gage_data = empty_data(full_dt_range(wtr_yr))
-
-    ## Empty list to test all files are from same gage as first file 
-    gage_test = []
-    
-    ## looping over list of csv files in location given in argument above
-    for param_file in glob.glob(loc + "/*.csv"):
-        
-        data_dict = aq_reader(param_file)
-        gage_test.append(data_dict["station"])
-        root = Tk()
-        root.title("Progress Report")
-        
-        ## Checking gage numbers
-        if data_dict["station"] != gage_test[0]:
-            ## root.withdraw() removes parent widget to show only error message
-            root.withdraw()
-            messagebox.showerror("Invalid file entry: ", "Data file not from same station!")
-            continue
-        
-        else:
-            gage_dict = fill_empties(gage_data, data_dict)
-            prompt = data_dict["param"] + " Processed!"
-            img = PhotoImage(file =  "logo/USGSlogo_gre_sm.png")
-            
-            logo = Label(root, image = img)
-            logo.grid(row = 0, column = 0, columnspan = 2)
-            
-            label = Label(root, compound = "center" , text = prompt,
-                    font = 'Verdana 12')#, fg = 'white')
-            label.grid(row = 0, column = 1)
-            
-            ## Message destroys itself after 10 secs to limit interaction required
-            root.after(10000, lambda : root.destroy())
-            root.mainloop()
-    
-    plot(gage_dict)
-    writetocsv(gage_dict, data_dict, time_dict, out_path.get())
-
-    root = Tk()
-    root.withdraw()
-    messagebox.showinfo("Processing complete", "Output written as " + out_path.get()) 
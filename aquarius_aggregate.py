@@ -0,0 +1,95 @@
+import os
+import numpy as np
+from aquarius_core import PARAMETERS
+
+## Aggregation period, datetime64 unit that defines its bins
+PERIODS = {"hourly" : "h", "daily" : "D", "monthly" : "M"}
+
+REDUCTIONS = ("sum", "mean", "min", "max")
+
+## (column, table index, reduction) of every aggregated product column
+AGGREGATE_RULES = [(entry["column"], j, how) for j, entry in enumerate(PARAMETERS)
+        for how in entry["aggregate"]]
+
+
+def aggregate_path(out, period):
+    """
+    Returns the file an aggregated product is written to - ex. licking_river.daily.csv
+    """
+    if out.endswith(".gz"):
+        out = out[:-len(".gz")]
+    return os.path.splitext(out)[0] + "." + period + ".csv"
+
+
+def period_starts(dt_range, period):
+    """
+    Returns the index of the first slot of each period bin of a sorted datetime range and the
+    start of each bin as text - "YYYY-mm-dd HH:MM" hourly, "YYYY-mm-dd" daily, "YYYY-mm" monthly.
+    """
+    bins = np.asarray(dt_range, dtype = "datetime64[m]").astype("datetime64[" + PERIODS[period] + "]")
+    starts = np.flatnonzero(np.concatenate(([True], bins[1:] != bins[:-1]))) if len(bins) else \
+            np.zeros(0, dtype = np.intp)
+
+    if period == "hourly":
+        labels = np.char.replace(np.datetime_as_string(bins[starts].astype("datetime64[m]")), "T", " ")
+    else:
+        labels = np.datetime_as_string(bins[starts])
+
+    return starts, labels
+
+
+def aggregate(table, dt_range, period, rules):
+
+    """
+    Reduces the rows of a (slots x parameters) table to one row per period bin. rules is a list
+    of (name, column index, reduction) with reduction one of REDUCTIONS. Every reduction ignores
+    np.nan values and a bin without values gives np.nan. Bins are reduced as segments of the
+    table with ufunc.reduceat, each reduction once over all the columns that use it. Returns the
+    bin labels and a list of (name_reduction, values) columns in rule order.
+    """
+    starts, labels = period_starts(dt_range, period)
+    results = {}
+    if len(starts):
+        for how in REDUCTIONS:
+            idx = sorted(set(j for name, j, rule in rules if rule == how))
+            if not idx:
+                continue
+            values = table[:, idx]
+            if how in ("min", "max"):
+                ## fmin/fmax skip np.nan and leave bins that are all np.nan as np.nan
+                ufunc = np.fmin if how == "min" else np.fmax
+                reduced = ufunc.reduceat(values, starts, axis = 0)
+            else:
+                present = ~np.isnan(values)
+                count = np.add.reduceat(present, starts, axis = 0, dtype = np.int64)
+                total = np.add.reduceat(np.where(present, values, 0), starts, axis = 0,
+                        dtype = np.double)
+                with np.errstate(invalid = "ignore", divide = "ignore"):
+                    reduced = total / count if how == "mean" else np.where(count, total, np.nan)
+            for k, j in enumerate(idx):
+                results[(j, how)] = reduced[:, k]
+
+    columns = [(name + "_" + how, results.get((j, how), np.zeros(0))) for name, j, how in rules]
+
+    return labels, columns
+
+
+def write_aggregate(path, station, labels, columns, append = False):
+
+    """
+    Writes an aggregated product as .csv - station number, period start and one column per
+    reduction. Values are formatted a column at a time the way write_rows formats the SD1 file.
+    With append the rows are added to the end of an existing product without a header.
+    """
+    text = [[station] * len(labels), np.asarray(labels).tolist()]
+    for name, values in columns:
+        if values.dtype == np.float64:
+            text.append(list(map(repr, values.tolist())))
+        else:
+            text.append(values.astype(str).tolist())
+
+    header = ["station_num", "period"] + [name for name, values in columns]
+    with open(path, "a" if append else "w", newline = "") as f:
+        if not append:
+            f.write(",".join(header) + "\r\n")
+        f.writelines(",".join(row) + "\r\n" for row in zip(*text))
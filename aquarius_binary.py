@@ -0,0 +1,148 @@
+import json
+import os
+import numpy as np
+
+## Bumped whenever the layout of a bundle changes
+BUNDLE_VERSION = 1
+
+MANIFEST = "manifest.json"
+TIME_FILE = "dt.npy"
+
+
+def bundle_path(out):
+    """
+    Returns the binary bundle directory written alongside an SD1 .csv file - ex. licking_river.sd1
+    """
+    if out.endswith(".gz"):
+        out = out[:-len(".gz")]
+    return os.path.splitext(out)[0] + ".sd1"
+
+
+def param_columns(gage_dict):
+    """
+    Returns the parameter columns of a gage_dict in SD1 order.
+    """
+    return [key for key in gage_dict if key != "dt_range" and isinstance(gage_dict[key], np.ndarray)
+            and gage_dict[key].ndim == 1]
+
+
+def write_bundle(gage_dict, data_dict, path):
+
+    """
+    Writes the gage_dict as a columnar binary bundle: a directory with a datetime64[m] time axis,
+    one .npy array per parameter and a manifest.json holding the station, name and units.
+    Every array can be memory-mapped on its own by read_column. The quality codes and QA flags
+    of a parameter, when the gage_dict holds them, are written as <column>.quality.npy (one row
+    per quality field, categories in the manifest) and <column>.qa.npy.
+    """
+    os.makedirs(path, exist_ok = True)
+    units = gage_dict.get("units", {})
+
+    dt = np.asarray(gage_dict["dt_range"], dtype = "datetime64[m]")
+    np.save(os.path.join(path, TIME_FILE), dt)
+
+    columns = {}
+    for column in param_columns(gage_dict):
+        values = np.ascontiguousarray(gage_dict[column])
+        np.save(os.path.join(path, column + ".npy"), values)
+        columns[column] = {"file" : column + ".npy", "units" : units.get(column, ""),
+                "dtype" : str(values.dtype)}
+        columns[column].update(write_extras(gage_dict, column, path))
+
+    manifest = {"version" : BUNDLE_VERSION, "station" : data_dict["station"],
+            "name" : data_dict["name"], "length" : len(dt), "time" : TIME_FILE,
+            "start" : str(dt[0]) if len(dt) else None, "columns" : columns}
+
+    ## Manifest last so a bundle is only complete once it exists
+    tmp_path = os.path.join(path, MANIFEST + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent = 1)
+    os.replace(tmp_path, os.path.join(path, MANIFEST))
+
+
+def write_extras(gage_dict, column, path):
+    """
+    Writes the quality codes and QA flags a gage_dict holds for a column into a bundle and
+    returns the manifest entries describing them.
+    """
+    info = {}
+    if column in gage_dict.get("quality", {}):
+        quality = gage_dict["quality"][column]
+        np.save(os.path.join(path, column + ".quality.npy"),
+                np.stack([codes for categories, codes in quality.values()]))
+        info["quality"] = {"file" : column + ".quality.npy",
+                "categories" : {field : categories for field, (categories, codes) in quality.items()}}
+    if column in gage_dict.get("flags", {}):
+        np.save(os.path.join(path, column + ".qa.npy"), gage_dict["flags"][column])
+        info["flags"] = column + ".qa.npy"
+
+    return info
+
+
+def bundle_manifest(path):
+    """
+    Returns the manifest dictionary of a binary bundle.
+    """
+    with open(os.path.join(path, MANIFEST)) as f:
+        manifest = json.load(f)
+    if manifest.get("version") != BUNDLE_VERSION:
+        raise ValueError("Unsupported SD1 bundle version in " + path)
+
+    return manifest
+
+
+def time_slice(dt, start = None, end = None):
+    """
+    Returns the slice of the sorted time axis dt from start up to but not including end. Either
+    may be None, a datetime, a datetime64 or an ISO string - ex. "2018-03-01".
+    """
+    lo = 0 if start is None else int(np.searchsorted(dt, np.datetime64(start, "m")))
+    hi = len(dt) if end is None else int(np.searchsorted(dt, np.datetime64(end, "m")))
+
+    return slice(lo, hi)
+
+
+def read_column(path, column, start = None, end = None):
+
+    """
+    Returns the (datetime64 time axis, values) of one parameter of a binary bundle between start
+    and end. Both arrays are memory-mapped, so only the pages of the requested rows are read.
+    """
+    manifest = bundle_manifest(path)
+    if column not in manifest["columns"]:
+        raise KeyError("No column " + column + " in " + path)
+
+    dt = np.load(os.path.join(path, manifest["time"]), mmap_mode = "r")
+    values = np.load(os.path.join(path, manifest["columns"][column]["file"]), mmap_mode = "r")
+    rows = time_slice(dt, start, end)
+
+    return dt[rows], values[rows]
+
+
+def load_bundle(path, columns = None, start = None, end = None):
+
+    """
+    Returns a gage_dict style dictionary of memory-mapped arrays from a binary bundle, limited to
+    the given columns (all when None) and to the rows between start and end. The time axis is
+    under "dt_range" and the units of each column under "units", and the quality codes and QA
+    flags of the columns that have them under "quality" and "flags".
+    """
+    manifest = bundle_manifest(path)
+    dt = np.load(os.path.join(path, manifest["time"]), mmap_mode = "r")
+    rows = time_slice(dt, start, end)
+
+    gage_dict = {"dt_range" : dt[rows]}
+    for column in columns or manifest["columns"]:
+        info = manifest["columns"][column]
+        gage_dict[column] = np.load(os.path.join(path, info["file"]), mmap_mode = "r")[rows]
+        if "quality" in info:
+            codes = np.load(os.path.join(path, info["quality"]["file"]), mmap_mode = "r")
+            gage_dict.setdefault("quality", {})[column] = {field : (categories, codes[i, rows])
+                for i, (field, categories) in enumerate(info["quality"]["categories"].items())}
+        if "flags" in info:
+            gage_dict.setdefault("flags", {})[column] = np.load(os.path.join(path, info["flags"]),
+                    mmap_mode = "r")[rows]
+    gage_dict["units"] = {column : manifest["columns"][column]["units"]
+            for column in columns or manifest["columns"]}
+
+    return gage_dict
@@ -0,0 +1,272 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+import numpy as np
+from aquarius_sources import source_file
+
+## Bumped whenever the layout of a cache entry changes so stale entries are ignored
+CACHE_VERSION = 3
+
+## Parsed AQUARIUS files are kept under ~/.cache/aquarius_sd1 unless --cache-dir is given
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "aquarius_sd1")
+DEFAULT_CACHE_MB = 1024
+
+HEADER_KEYS = ("station", "name", "param", "units")
+
+## Files of a cache entry after its hash
+ENTRY_SUFFIXES = (".json", ".timestamps.npy", ".values.npy", ".quality.npy")
+
+## Parts of a cache_config that only live in the process that made it
+MEMORY_KEYS = ("memory", "memory_bytes", "lock")
+
+
+def cache_config(cache_dir = DEFAULT_CACHE_DIR, max_mb = DEFAULT_CACHE_MB, rebuild = False,
+        memory_mb = 0):
+    """
+    Returns the dictionary describing a parsed file cache that is handed to ingest_file.
+    When rebuild is True every file is parsed again and its entry replaced. With memory_mb the
+    parsed arrays are also kept in memory, least recently used first out above that size, for
+    long running processes. cache_dir may be None to keep them in memory only.
+    """
+    cache = {"dir" : cache_dir, "max_bytes" : int(max_mb * 1024 * 1024), "rebuild" : rebuild}
+    if memory_mb:
+        cache.update({"memory" : OrderedDict(), "memory_bytes" : int(memory_mb * 1024 * 1024),
+            "lock" : threading.Lock()})
+
+    return cache
+
+
+def worker_cache(cache):
+    """
+    Returns the part of a cache_config that can be sent to worker processes, without the
+    in-memory entries.
+    """
+    if cache is None:
+        return None
+    return {key : value for key, value in cache.items() if key not in MEMORY_KEYS}
+
+
+def file_digest(path):
+    """
+    Returns a blake2b hash of the contents of a file.
+    """
+    digest = hashlib.blake2b(digest_size = 20)
+    with open(path, "rb") as f:
+        for block in iter(lambda : f.read(1 << 20), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def entry_paths(cache, path):
+    """
+    Returns the metadata, timestamp, value and quality code file names of the cache entry for an
+    AQUARIUS file. Entries are named after a hash of the absolute file path.
+    """
+    key = hashlib.blake2b(os.path.abspath(path).encode("utf-8"), digest_size = 16).hexdigest()
+    base = os.path.join(cache["dir"], key)
+
+    return tuple(base + suffix for suffix in ENTRY_SUFFIXES)
+
+
+def cache_lookup(cache, path):
+
+    """
+    Returns the data_dict for an AQUARIUS file from the cache, or None when the file has no entry
+    or has changed since it was stored. An entry matches when the file size and modification time
+    are unchanged, or when the size is unchanged and the contents hash the same. Zip members are
+    checked against their archive. Arrays are loaded memory-mapped.
+    """
+    if cache["rebuild"]:
+        return None
+
+    if "memory" in cache:
+        data_dict = memory_lookup(cache, path)
+        if data_dict is not None:
+            return data_dict
+    if cache["dir"] is None:
+        return None
+
+    meta_path, ts_path, val_path, quality_path = entry_paths(cache, path)
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+        stat = os.stat(source_file(path))
+    except (OSError, ValueError):
+        return None
+
+    if meta.get("version") != CACHE_VERSION or meta["size"] != stat.st_size:
+        return None
+
+    if meta["mtime_ns"] != stat.st_mtime_ns:
+        ## Touched but possibly unchanged, e.g. copied again from the export share
+        if meta["hash"] != file_digest(source_file(path)):
+            return None
+        meta["mtime_ns"] = stat.st_mtime_ns
+        write_meta(meta_path, meta)
+
+    try:
+        timestamps = np.load(ts_path, mmap_mode = "r")
+        values = np.load(val_path, mmap_mode = "r")
+        codes = np.load(quality_path, mmap_mode = "r")
+    except (OSError, ValueError):
+        return None
+
+    ## Modification time of the metadata file records the last use for eviction
+    try:
+        os.utime(meta_path)
+    except OSError:
+        pass
+
+    data_dict = {key : meta[key] for key in HEADER_KEYS}
+    data_dict["timestamps"] = timestamps
+    data_dict["values"] = values
+    data_dict["quality"] = {field : (categories, codes[i])
+            for i, (field, categories) in enumerate(meta["categories"].items())}
+    if "memory" in cache:
+        memory_store(cache, path, data_dict)
+
+    return data_dict
+
+
+def memory_lookup(cache, path):
+    """
+    Returns a copy of the in-memory data_dict of a source when its file is unchanged, or None.
+    """
+    try:
+        stat = os.stat(source_file(path))
+    except OSError:
+        return None
+
+    key = os.path.abspath(path)
+    with cache["lock"]:
+        entry = cache["memory"].get(key)
+        if entry is None or entry["state"] != (stat.st_size, stat.st_mtime_ns):
+            return None
+        cache["memory"].move_to_end(key)
+
+    return dict(entry["data"])
+
+
+def memory_store(cache, path, data_dict):
+    """
+    Keeps the parsed arrays of a source in memory, removing the least recently used entries
+    above the memory size of the cache.
+    """
+    stat = os.stat(source_file(path))
+    data = {key : data_dict[key] for key in HEADER_KEYS + ("timestamps", "values", "quality")}
+    size = data["timestamps"].nbytes + data["values"].nbytes + sum(codes.nbytes
+            for categories, codes in data["quality"].values())
+
+    with cache["lock"]:
+        cache["memory"][os.path.abspath(path)] = {"state" : (stat.st_size, stat.st_mtime_ns),
+            "data" : data, "bytes" : size}
+        total = sum(entry["bytes"] for entry in cache["memory"].values())
+        while total > cache["memory_bytes"] and len(cache["memory"]) > 1:
+            total -= cache["memory"].popitem(last = False)[1]["bytes"]
+
+
+def replace_file(path, write):
+
+    """
+    Writes a cache file through a temporary file of its own in the same directory, so readers
+    never see half of it and threads or processes storing the same entry at once do not write
+    over each other. write is called with the open binary file. When another writer wins the
+    race to replace the file the store still counts as done, both hold the same entry.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(path),
+            prefix = os.path.basename(path) + ".", suffix = ".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        if not os.path.exists(path):
+            raise
+
+
+def write_meta(meta_path, meta):
+    """
+    Writes the metadata of a cache entry through a temporary file so readers never see half of it.
+    """
+    replace_file(meta_path, lambda f : f.write(json.dumps(meta).encode("utf-8")))
+
+
+def cache_store(cache, path, data_dict):
+
+    """
+    Stores the parsed timestamps, values and quality codes of an AQUARIUS file as .npy arrays
+    with the header information and quality categories in a .json file, then evicts the least
+    recently used entries above the cache size. Entries are also kept in memory when the cache
+    has a memory size.
+    """
+    if "memory" in cache:
+        memory_store(cache, path, data_dict)
+    if cache["dir"] is None:
+        return
+
+    os.makedirs(cache["dir"], exist_ok = True)
+    meta_path, ts_path, val_path, quality_path = entry_paths(cache, path)
+    stat = os.stat(source_file(path))
+
+    meta = {key : data_dict[key] for key in HEADER_KEYS}
+    meta.update({"version" : CACHE_VERSION, "path" : os.path.abspath(path), "size" : stat.st_size,
+        "mtime_ns" : stat.st_mtime_ns, "hash" : file_digest(source_file(path)),
+        "categories" : {field : categories for field, (categories, codes)
+            in data_dict["quality"].items()}})
+    ## Quality codes of every field in one (fields x rows) array
+    codes = np.stack([np.asarray(codes, dtype = np.int16)
+        for categories, codes in data_dict["quality"].values()])
+
+    ## Arrays go first and the metadata last, an entry only counts once its metadata exists
+    for array_path, array in ((ts_path, data_dict["timestamps"]), (val_path, data_dict["values"]),
+            (quality_path, codes)):
+        replace_file(array_path, lambda f : np.save(f, np.asarray(array)))
+    write_meta(meta_path, meta)
+
+    cache_evict(cache)
+
+
+def cache_evict(cache):
+
+    """
+    Removes the least recently used entries until the cache is no larger than its maximum size.
+    """
+    entries = []
+    total = 0
+    try:
+        names = os.listdir(cache["dir"])
+    except OSError:
+        return
+
+    for name in names:
+        if not name.endswith(".json"):
+            continue
+        base = os.path.join(cache["dir"], name[:-len(".json")])
+        files = [base + suffix for suffix in ENTRY_SUFFIXES]
+        try:
+            used = os.stat(files[0]).st_mtime_ns
+            size = sum(os.stat(item).st_size for item in files if os.path.exists(item))
+        except OSError:
+            continue
+        entries.append((used, size, files))
+        total += size
+
+    for used, size, files in sorted(entries):
+        if total <= cache["max_bytes"]:
+            break
+        for item in files:
+            try:
+                os.remove(item)
+            except OSError:
+                pass
+        total -= size
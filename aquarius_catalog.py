@@ -0,0 +1,255 @@
+import csv
+import hashlib
+import re
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from aquarius_core import aq_header, param_column
+from aquarius_sources import open_source, source_size
+
+## Columns of a catalog written by write_catalog, in order
+CATALOG_FIELDS = ("source", "station", "name", "param", "column", "units", "start", "end",
+        "rows", "status", "note")
+
+## Threads reading headers at once, the reads mostly wait on the disk
+SCAN_JOBS = 8
+
+## Exports whose span ends this close outside the grid are still parsed, their local times
+## may shift across the boundary
+SPAN_MARGIN = np.timedelta64(1, "D")
+
+## "Export options: Corrected signal from 2018-02-01T05:00:00Z to 2018-07-09T04:59:00Z"
+STAMP = r"(\d{4}-\d\d-\d\dT\d\d:\d\d)(?::\d\d)?Z?"
+SPAN = re.compile("from " + STAMP + " to " + STAMP)
+OFFSET = re.compile(r"UTC([+-])(\d\d):(\d\d)")
+
+
+def header_span(lines):
+
+    """
+    Returns the first and last local timestamps of an export as datetime64[m], from the UTC
+    span of the "Export options" header line shifted by the "UTC offset" line, or (None, None)
+    when the header does not give them.
+    """
+    offset = np.timedelta64(0, "m")
+    span = None
+    for line in lines:
+        if line.startswith("# UTC offset"):
+            match = OFFSET.search(line)
+            if match:
+                sign = -1 if match.group(1) == "-" else 1
+                minutes = int(match.group(2)) * 60 + int(match.group(3))
+                offset = np.timedelta64(sign * minutes, "m")
+        elif line.startswith("# Export options"):
+            span = SPAN.search(line)
+    if span is None:
+        return None, None
+
+    return (np.datetime64(span.group(1), "m") + offset, np.datetime64(span.group(2), "m") + offset)
+
+
+def scan_header(source):
+
+    """
+    Reads the header lines, column names and first data row of an AQUARIUS source and returns
+    its catalog entry - source, station, name, param, column (None when the parameter is not in
+    the PARAMETERS registry), units, start and end (datetime64[m] or None), rows, estimated
+    from the uncompressed size and the length of the first row (None when the size is not known
+    without decompressing), and generated, the first header line with the export's file name
+    and time. No further data rows are read. A source that cannot be read gets its reason
+    under "error".
+    """
+    entry = {"source" : source}
+    header, header_bytes = [], 0
+    try:
+        with open_source(source) as f:
+            line = f.readline()
+            while line.startswith(b"#"):
+                header.append(line.decode("utf-8", "replace"))
+                header_bytes += len(line)
+                line = f.readline()
+            ## Column names, then the first data row
+            header_bytes += len(line)
+            first_row = f.readline()
+        entry.update(aq_header(header, verbose = False))
+    except Exception as err:
+        entry["error"] = str(err) or type(err).__name__
+        return entry
+
+    entry["column"] = param_column(entry["param"])
+    entry["generated"] = header[0].strip()
+    entry["start"], entry["end"] = header_span(header)
+    size = source_size(source)
+    entry["rows"] = None
+    if size is not None and first_row.strip():
+        entry["rows"] = int(round(max(0, size - header_bytes) / len(first_row)))
+
+    return entry
+
+
+def source_digest(entry):
+    """
+    Returns a blake2b hash of the decompressed contents of a catalog entry's source, computed on
+    first use and kept in the entry.
+    """
+    if "digest" not in entry:
+        digest = hashlib.blake2b(digest_size = 20)
+        with open_source(entry["source"]) as f:
+            for block in iter(lambda : f.read(1 << 20), b""):
+                digest.update(block)
+        entry["digest"] = digest.hexdigest()
+
+    return entry["digest"]
+
+
+def same_export(entry, other):
+    """
+    Returns True when two catalog entries hold the same export: their header and row estimate
+    match, including the generated line, and so do their contents. Only sources that pass the
+    header checks are read in full.
+    """
+    if any(entry[key] != other[key] for key in ("units", "start", "end", "rows", "generated")):
+        return False
+    try:
+        return source_digest(entry) == source_digest(other)
+    except OSError:
+        return False
+
+
+def flag_catalog(catalog):
+
+    """
+    Sets the "status" and "note" of every catalog entry, in place and in catalog order:
+    ok - the source is parsed
+    error - the header could not be read, note holds the reason
+    unmapped - the parameter is not in the PARAMETERS registry
+    duplicate - a later source of the same station and column holds the same export, the same
+        header and contents (see same_export), so only the later copy is parsed
+    conflict - the source is parsed but disagrees with an earlier one: the station name or units
+        differ, or the spans overlap and its values replace those of the earlier source
+    """
+    names = {}
+    kept = {}
+    for entry in catalog:
+        if "error" in entry:
+            entry["status"], entry["note"] = "error", entry["error"]
+            continue
+        entry["status"], entry["note"] = "ok", ""
+        if entry["column"] is None:
+            entry["status"] = "unmapped"
+            entry["note"] = "parameter " + entry["param"] + " is not in the registry"
+            continue
+
+        name = names.setdefault(entry["station"], entry["name"])
+        if entry["name"] != name:
+            entry["status"], entry["note"] = "conflict", "station name differs from " + name
+
+        ## Of two copies of an export the later is kept, so it still replaces the values of
+        ## any source between them as it would if both were parsed
+        group = kept.setdefault((entry["station"], entry["column"]), [])
+        for other in list(group):
+            if same_export(entry, other):
+                other["status"], other["note"] = "duplicate", "same export as " + entry["source"]
+                group.remove(other)
+            elif entry["units"] != other["units"]:
+                entry["status"] = "conflict"
+                entry["note"] = "units " + entry["units"] + " differ from " + other["source"]
+            elif None not in (entry["start"], other["start"]) and \
+                    entry["start"] <= other["end"] and other["start"] <= entry["end"]:
+                entry["status"] = "conflict"
+                entry["note"] = "overlaps " + other["source"] + ", its values replace those"
+        group.append(entry)
+
+    return catalog
+
+
+def scan_headers(sources, jobs = SCAN_JOBS):
+
+    """
+    Returns the flagged catalog of a list of AQUARIUS sources, see scan_header and flag_catalog.
+    Headers are read in a pool of jobs threads and entries are kept in source order.
+    """
+    if jobs <= 1 or len(sources) <= 1:
+        catalog = [scan_header(source) for source in sources]
+    else:
+        with ThreadPoolExecutor(max_workers = min(jobs, len(sources))) as executor:
+            catalog = list(executor.map(scan_header, sources))
+
+    return flag_catalog(catalog)
+
+
+def plan_sources(catalog, dt_range = None, station = None):
+
+    """
+    Plans the full parse from a flagged catalog without reading any data rows. Returns the
+    sources to parse, in catalog order, and (source, reason) pairs of the sources left out:
+    those of another station than station, duplicates, unmapped parameters and exports whose
+    span lies outside dt_range. Sources whose header could not be read are kept so their error
+    is reported when they are parsed. Raises ValueError when the catalog holds several stations
+    and station is None, rather than letting the last file name the output.
+    """
+    stations = sorted(set(entry["station"] for entry in catalog if "error" not in entry))
+    if station is None and len(stations) > 1:
+        raise ValueError("AQUARIUS files of " + str(len(stations)) + " stations found - "
+                + ", ".join(stations) + " - choose one with --station")
+
+    first = last = None
+    if dt_range is not None and len(dt_range):
+        first = np.datetime64(dt_range[0], "m") - SPAN_MARGIN
+        last = np.datetime64(dt_range[-1], "m") + SPAN_MARGIN
+
+    planned, skipped = [], []
+    for entry in catalog:
+        if "error" in entry:
+            planned.append(entry["source"])
+        elif station is not None and entry["station"] != station:
+            skipped.append((entry["source"], "station " + entry["station"] + " is not " + station))
+        elif entry["status"] in ("duplicate", "unmapped"):
+            skipped.append((entry["source"], entry["note"]))
+        elif first is not None and entry["start"] is not None and \
+                (entry["end"] < first or entry["start"] > last):
+            skipped.append((entry["source"], "exported " + str(entry["start"]) + " to "
+                    + str(entry["end"]) + ", outside the time range"))
+        else:
+            planned.append(entry["source"])
+
+    return planned, skipped
+
+
+def catalog_rows(catalog):
+    """
+    Returns the catalog entries as lists of text in CATALOG_FIELDS order, blank where unknown.
+    """
+    return [["" if entry.get(field) is None else str(entry.get(field)) for field in CATALOG_FIELDS]
+            for entry in catalog]
+
+
+def write_catalog(path, catalog):
+    """
+    Writes a catalog as a .csv file with a CATALOG_FIELDS header.
+    """
+    with open(path, "w", newline = "") as f:
+        writer = csv.writer(f)
+        writer.writerow(CATALOG_FIELDS)
+        writer.writerows(catalog_rows(catalog))
+
+
+def print_catalog(catalog):
+    """
+    Prints one line per catalog entry and the number of entries of each status.
+    """
+    for entry in catalog:
+        if "error" in entry:
+            print(entry["source"] + " : error : " + entry["error"])
+            continue
+        print(entry["station"] + " " + str(entry["column"] or entry["param"]) + " ("
+                + entry["units"] + ") " + str(entry["start"]) + " to " + str(entry["end"]) + ", "
+                + ("~" + str(entry["rows"]) if entry["rows"] is not None else "unknown")
+                + " rows : " + entry["status"]
+                + (" - " + entry["note"] if entry["note"] else "") + " : " + entry["source"])
+
+    counts = {}
+    for entry in catalog:
+        counts[entry["status"]] = counts.get(entry["status"], 0) + 1
+    print(str(len(catalog)) + " sources, " + str(len(set(entry["station"] for entry in catalog
+            if "error" not in entry))) + " stations : "
+            + ", ".join(status + " " + str(n) for status, n in sorted(counts.items())))
@@ -0,0 +1,968 @@
+import csv
+import gzip
+import io
+import mmap
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import repeat
+import numpy as np
+from aquarius_cache import cache_lookup, cache_store, worker_cache
+from aquarius_profile import collect, emit, enabled, stage
+from aquarius_sources import is_plain, open_source
+from aquarius_stats import finish_stats, new_stats, summarize, update_stats
+
+## Reading, aligning and writing of SD1 data with no plotting or GUI dependencies, so
+## headless runs and other tools can import it without loading matplotlib or tkinter
+
+## Parameter registry in SD1 column order. "param" is the AQUARIUS "Value parameter" up to
+## its first comma, "column" the gage_dict key, "header" the SD1 .csv column name, "label"
+## the y axis label of its plot, "aggregate" the reductions used for the hourly, daily and
+## monthly products and "qa" the limits of the QA checks in aquarius_qa (None skips a check).
+## A new parameter only needs a new entry here.
+PARAMETERS = [
+    {"param" : "Gage height", "column" : "gageheight_ft", "units" : "ft",
+        "header" : "gageheight_ft", "label" : "Gage height (ft)",
+        "aggregate" : ["mean"],
+        "qa" : {"min" : -10, "max" : 100, "spike" : 3, "flat_minutes" : 1440}},
+    {"param" : "Discharge", "column" : "discharge_cfs", "units" : "ft^3/s",
+        "header" : "discharge_cfs", "label" : "Discharge (cfs)",
+        "aggregate" : ["mean"],
+        "qa" : {"min" : 0, "max" : 1000000, "spike" : None, "flat_minutes" : 1440}},
+    {"param" : "Precipitation", "column" : "precip_in", "units" : "in",
+        "header" : "precip_in", "label" : "Precipitation (in)",
+        "aggregate" : ["sum"],
+        "qa" : {"min" : 0, "max" : 10, "spike" : None, "flat_minutes" : None}},
+    {"param" : "Temperature", "column" : "temp_c", "units" : "degC",
+        "header" : "temp_c", "label" : "Temperature (deg C)",
+        "aggregate" : ["min", "max"],
+        "qa" : {"min" : -5, "max" : 45, "spike" : 5, "flat_minutes" : 720}},
+    {"param" : "Dissolved oxygen", "column" : "do_mgL", "units" : "mg/l",
+        "header" : "do_mgL", "label" : "Dissolved Oxygen (mg/L)",
+        "aggregate" : ["mean"],
+        "qa" : {"min" : 0, "max" : 25, "spike" : 3, "flat_minutes" : 720}},
+    {"param" : "pH", "column" : "pH_su", "units" : "pH Units",
+        "header" : " pH_su", "label" : "pH",
+        "aggregate" : ["mean"],
+        "qa" : {"min" : 0, "max" : 14, "spike" : 1, "flat_minutes" : 720}},
+    {"param" : "Specific cond at 25C", "column" : "cond_umhos", "units" : "uS/cm",
+        "header" : "conductance_umhos", "label" : "Specific Conductance @ 25 deg C (uS/cm)",
+        "aggregate" : ["mean"],
+        "qa" : {"min" : 0, "max" : 100000, "spike" : 500, "flat_minutes" : 720}},
+    {"param" : "Turbidity", "column" : "turb_ntu", "units" : "_FNU",
+        "header" : "turb_ntu", "label" : "Turbidity (FNU)",
+        "aggregate" : ["mean"],
+        "qa" : {"min" : 0, "max" : 4000, "spike" : 500, "flat_minutes" : 720}},
+    {"param" : "Mean water velocity", "column" : "velocity_ft_s", "units" : "ft/s",
+        "header" : "Velocity", "label" : "Velocity (ft/s)",
+        "aggregate" : ["mean"],
+        "qa" : {"min" : -20, "max" : 20, "spike" : 3, "flat_minutes" : 1440}},
+    {"param" : "NO3+NO2", "column" : "nitrate_mgL", "units" : "mg/l",
+        "header" : "Nitrate", "label" : "Nitrate (mg/L)",
+        "aggregate" : ["mean"],
+        "qa" : {"min" : 0, "max" : 100, "spike" : 5, "flat_minutes" : 720}},
+]
+
+PARAM_INDEX = {entry["param"] : entry for entry in PARAMETERS}
+
+## Parameter columns in the order they appear in the SD1 file
+SD1_PARAMS = [entry["column"] for entry in PARAMETERS]
+
+## AQUARIUS columns after the value kept as integer codes - Approval Level, Grade and
+## Qualifiers. A slot of the gage grid no row landed on has code NO_CODE.
+QUALITY_FIELDS = ("approval", "grade", "qualifiers")
+NO_CODE = -1
+
+## Station and time columns that come before the parameters in the SD1 file
+SD1_HEADER = ["station_num","station_name","station","Date","Time"," Mins","DT", "DT2"]
+
+## How rows that land on the same slot are resolved, see align_values
+SNAP_POLICIES = ("first", "nearest", "mean")
+
+## Positions of the digits of a "YYYY-mm-dd HH:MM" timestamp
+STAMP_DIGITS = [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15]
+
+## "00" to "99" for building the SD1 date and time columns
+TWO_DIGITS = np.array(["%02d" % i for i in range(100)])
+
+## Rows formatted and written at a time by writetocsv
+WRITE_BLOCK = 8192
+
+## Files of at least MMAP_MIN_BYTES are parsed memory-mapped, and they and compressed or
+## archived exports are parsed READ_CHUNK bytes at a time, so peak memory follows the parsed
+## arrays rather than the size of the file
+MMAP_MIN_BYTES = 64 * 1024 * 1024
+READ_CHUNK = 4 * 1024 * 1024
+
+
+def full_dt_range(wtr_yr, interval = 15):
+    """
+    Returns a full datetime64[m] range with interval minute increments for a specific water 
+    year (10/1 to 9/30) determined by the only required argument
+    """
+    ## Water year (10/1 - 9/30) full range- 15 minute increments by default
+    return np.arange(np.datetime64(str(wtr_yr - 1) + "-10-01T00:00"), 
+            np.datetime64(str(wtr_yr) + "-10-01T00:00"), np.timedelta64(interval, "m"))
+
+
+def parse_range(text):
+    """
+    Returns the start and end of a time range written START/END as datetime64[m] - ex.
+    2001-10-01/2021-10-01 - end not included. Raises ValueError when text is not such a range.
+    """
+    start, sep, end = text.partition("/")
+    if not sep:
+        raise ValueError("Time range must be START/END : " + text)
+    start, end = np.datetime64(start, "m"), np.datetime64(end, "m")
+    if end <= start:
+        raise ValueError("Time range ends before it starts : " + text)
+
+    return start, end
+
+
+def empty_data(dt_range, dtype = np.double):
+
+    """
+    Accepts only a datetime range returned in full_dt_range and returns a dictionary with a key
+    for each column needed in the SD1 file. All parameters share one (slots x parameters) np.nan
+    array of dtype under "table" and each parameter key holds its column of that array. The
+    datetime range is kept as a datetime64[m] array under "dt_range".
+    """
+    dt_range = np.asarray(dt_range, dtype = "datetime64[m]")
+    
+    ## One contiguous np.nan table for every param, equal in length to the datetime range
+    table = np.full((len(dt_range), len(PARAMETERS)), np.nan, dtype = dtype)
+
+    ## Dictionary for datetime range and empty param columns
+    empties = {"dt_range" : dt_range, "table" : table}
+    for j, entry in enumerate(PARAMETERS):
+        empties[entry["column"]] = table[:, j]
+
+    return empties
+
+
+def aq_header(lines, verbose = True):
+
+    """
+    Accepts the header lines of an AQUARIUS .csv file (every line up to the CSV column names)
+    and returns a dictionary with the station number, station name, parameter and units.
+    """
+    if not lines or "AQUARIUS" not in lines[0]:
+        if verbose:
+            print("WRONG FILE OR FORMAT!!!")
+        raise ValueError("Not an AQUARIUS .csv file")
+
+    station = lines[0].split("@")[1][:8]
+    name = lines[3].split(":")[1].split(",")[0].strip()
+    param = lines[6].split(":")[1].split(",")[0].strip()
+    units = lines[5].split(":")[1].split(",")[0].strip()
+    if verbose:
+        print_header(station, name, units)
+
+    return {"station" : station, "name" : name, "param" : param, "units" : units}
+
+
+def print_header(station, name, units):
+    """
+    Prints the station information read from an AQUARIUS header.
+    """
+    print(station)
+    print(name)
+    print("Units : " + units) 
+
+
+def parse_aq_rows(data):
+
+    """
+    Accepts the bytes of the data rows of an AQUARIUS .csv file and returns the timestamp
+    column as a datetime64[s] array, the value column as a float64 array and the quality
+    columns as {field : (categories, codes)} for each of QUALITY_FIELDS, see quality_codes. All
+    rows are parsed at once with numpy rather than line by line. The value column ends at the
+    next comma or at the end of the line, so exports without quality columns are read too and
+    their quality fields are empty. Blank lines and malformed rows - fewer than two commas, a
+    timestamp not written "YYYY-mm-dd HH:MM[:SS]" or not a real time (ex. 2018-02-31 or hour
+    25), or a value that is not a number - are skipped.
+    """
+    buf = np.frombuffer(data, dtype = np.uint8)
+
+    ## Start of every non empty line
+    newlines = np.flatnonzero(buf == ord("\n"))
+    starts = np.concatenate(([0], newlines + 1))
+    ends = np.concatenate((newlines, [len(buf)]))
+
+    ## First two commas of each line bound the timestamp column and start the value column,
+    ## lines without both are skipped
+    commas = np.flatnonzero(buf == ord(","))
+    first = np.searchsorted(commas, starts)
+    keep = first + 1 < len(commas)
+    keep[keep] = commas[first[keep] + 1] < ends[keep]
+    first = first[keep]
+    ts_start = commas[first] + 1
+    ts_end = commas[first + 1]
+    val_start = commas[first + 1] + 1
+
+    ## Value ends at a third comma when the quality columns follow it, else at the line end
+    line_end = ends[keep]
+    line_end = line_end - (buf[np.maximum(line_end - 1, 0)] == ord("\r"))
+    third = np.minimum(first + 2, len(commas) - 1)
+    quality = (first + 2 < len(commas)) & (commas[third] < line_end)
+    val_end = np.where(quality, commas[third], line_end)
+
+    ## Fixed width slicing of "YYYY-mm-dd HH:MM:SS" into integer fields
+    stamps = fixed_width(buf, ts_start, np.full(len(ts_start), 19), 19)
+    def field(offset, width):
+        out = np.zeros(len(ts_start), dtype = np.int64)
+        for k in range(width):
+            out = out * 10 + stamps[:, offset + k] - ord("0")
+        return out
+
+    ## Digits and separators must sit where the format puts them
+    digit = (stamps >= ord("0")) & (stamps <= ord("9"))
+    seps = stamps[:, [4, 7, 13]] == np.array([ord("-"), ord("-"), ord(":")], dtype = np.uint8)
+    valid = (ts_end - ts_start >= 16) & digit[:, STAMP_DIGITS].all(axis = 1) & seps.all(axis = 1) \
+            & ((stamps[:, 10] == ord(" ")) | (stamps[:, 10] == ord("T")))
+    with_seconds = ts_end - ts_start >= 19
+    valid &= ~with_seconds | ((stamps[:, 16] == ord(":")) & digit[:, 17] & digit[:, 18])
+
+    ## Fields must lie in range, numpy would roll 2018-02-31 or hour 25 into the next month
+    ## or day
+    month, day = field(5, 2), field(8, 2)
+    hour, minute = field(11, 2), field(14, 2)
+    second = np.where(with_seconds, field(17, 2), 0)
+    months = (field(0, 4) - 1970) * 12 + np.clip(month, 1, 12) - 1
+    month_start = months.astype("datetime64[M]").astype("datetime64[D]")
+    days = ((months + 1).astype("datetime64[M]").astype("datetime64[D]") - month_start
+            ).astype(np.int64)
+    valid &= (month >= 1) & (month <= 12) & (day >= 1) & (day <= days) & (hour <= 23) \
+            & (minute <= 59) & (second <= 59)
+
+    ## Seconds are kept so clock drift (ex. 00:14:59) can be snapped to its slot
+    timestamps = (month_start + (day - 1)).astype("datetime64[s]") \
+            + ((hour * 60 + minute) * 60 + second)
+
+    ## Value column gathered into a fixed width byte string array and cast in one call
+    widths = val_end - val_start
+    width = max(int(widths.max()) if len(widths) else 1, 3)
+    chars = fixed_width(buf, val_start, widths, width)
+    chars[widths == 0, :3] = np.frombuffer(b"nan", dtype = np.uint8)
+    texts = np.ascontiguousarray(chars).view("S" + str(width)).ravel()
+    try:
+        values = texts.astype(np.float64)
+    except ValueError:
+        ## Only files holding a value that is not a number are cast row by row
+        values = np.array([number(text) for text in texts.tolist()], dtype = np.float64)
+        valid &= ~np.isnan(values) | np.char.startswith(np.char.lower(np.char.strip(texts)),
+                b"nan")
+
+    ## Approval Level, Grade and Qualifiers follow the value to the end of the line
+    quality_start = np.where(quality, val_end + 1, line_end)
+
+    if valid.all():
+        return timestamps, values, quality_codes(buf, quality_start, line_end)
+    return (timestamps[valid], values[valid],
+            quality_codes(buf, quality_start[valid], line_end[valid]))
+
+
+def number(text):
+    """
+    Returns the float of a value column, np.nan when it is not a number.
+    """
+    try:
+        return float(text)
+    except ValueError:
+        return np.nan
+
+
+def fixed_width(buf, start, widths, width):
+
+    """
+    Returns a (rows x width) uint8 array of the bytes of buf from each start, zeroed past each
+    row's width. Rows are copied out of a strided window view of buf rather than through an
+    index array of every byte, and the few rows too close to the end of buf for a full window
+    are gathered byte by byte.
+    """
+    chars = np.zeros((len(start), width), dtype = np.uint8)
+    whole = start <= len(buf) - width
+    if len(buf) >= width:
+        chars[whole] = np.lib.stride_tricks.sliding_window_view(buf, width)[start[whole]]
+    cols = np.arange(width)
+    chars[~whole] = buf[np.minimum(start[~whole][:, None] + cols, len(buf) - 1)]
+    chars[cols >= widths[:, None]] = 0
+
+    return chars
+
+
+def quality_codes(buf, start, end):
+
+    """
+    Returns the Approval Level, Grade and Qualifiers of rows whose quality columns span the
+    [start, end) byte ranges of buf as integer codes: {field : (categories, codes)} with the
+    sorted distinct texts of each field and an int16 array of each row's index into them.
+    Rows mostly repeat the row before, so only the first row of each run of equal rows is
+    split into its fields, with the csv module so quoted Qualifiers may hold commas. Fields
+    a row lacks are empty.
+    """
+    widths = np.maximum(end - start, 0)
+    width = max(int(widths.max()) if len(widths) else 1, 1)
+    keys = fixed_width(buf, start, widths, width).view("S" + str(width)).ravel()
+
+    run = np.concatenate(([True], keys[1:] != keys[:-1])) if len(keys) else \
+            np.zeros(0, dtype = bool)
+    tails, run_codes = np.unique(keys[run], return_inverse = True)
+    rows = [(next(csv.reader([tail.decode("utf-8", "replace")]), []) + [""] * 3)[:3]
+            for tail in tails.tolist()]
+    row_runs = np.cumsum(run) - 1
+
+    quality = {}
+    for i, field in enumerate(QUALITY_FIELDS):
+        categories, codes = np.unique(np.array([row[i] for row in rows], dtype = str),
+                return_inverse = True)
+        quality[field] = (categories.tolist(), codes.astype(np.int16)[run_codes][row_runs])
+
+    return quality
+
+
+def merge_quality(parts):
+
+    """
+    Joins the quality columns of consecutive chunks of rows, from parse_aq_rows, into one set.
+    The categories of every chunk are combined and each chunk's codes renumbered to match.
+    """
+    quality = {}
+    for field in QUALITY_FIELDS:
+        categories = sorted(set(text for part in parts for text in part[field][0]))
+        lookup = {text : i for i, text in enumerate(categories)}
+        codes = [np.array([lookup[text] for text in part[field][0]] or [0],
+            dtype = np.int16)[part[field][1]] for part in parts]
+        quality[field] = (categories, np.concatenate(codes) if codes else
+                np.zeros(0, dtype = np.int16))
+
+    return quality
+
+
+def aq_reader(path, verbose = True, use_mmap = None):
+
+    """
+    Accepts the filepath argument to an AQUARIUS .csv file and returns a dictionary with desired data.
+    With use_mmap the file is read by aq_reader_mmap, which by default is done for files of at
+    least MMAP_MIN_BYTES.
+    """
+    if use_mmap is None:
+        use_mmap = os.path.getsize(path) >= MMAP_MIN_BYTES
+    if use_mmap:
+        return aq_reader_mmap(path, verbose)
+
+    with open(path, "rb") as f:
+        
+        ## Header lines are read one at a time up to and including the CSV column names
+        ## ("CSV data starts at line 15"), the rest of the file is parsed in bulk
+        header = []
+        for line in f:
+            if not line.startswith(b"#"):
+                break
+            header.append(line.decode("utf-8", "replace"))
+
+        data_dict = aq_header(header, verbose)
+        data = f.read()
+        if not line.startswith(b"ISO"):
+            data = line + data
+        timestamps, values, quality = parse_aq_rows(data)
+
+    ## Dictionary for AQUARIUS file
+    data_dict["timestamps"] = timestamps
+    data_dict["values"] = values
+    data_dict["quality"] = quality
+
+    return data_dict
+
+
+def mmap_chunks(mm, start, size = READ_CHUNK):
+    """
+    Yields (start, stop) byte ranges of a memory-mapped file from start to its end, about size
+    bytes each and ending just after a newline so no line is split between two ranges.
+    """
+    lo = start
+    while lo < len(mm):
+        hi = min(lo + size, len(mm))
+        if hi < len(mm):
+            cut = mm.rfind(b"\n", lo, hi)
+            hi = cut + 1 if cut >= 0 else (mm.find(b"\n", hi) + 1 or len(mm))
+        yield lo, hi
+        lo = hi
+
+
+def release_pages(mm, start, stop):
+    """
+    Drops the pages of a read memory-mapped range from the process where the platform allows,
+    so the resident size does not grow with the file. They are read again from the page cache
+    if touched.
+    """
+    if hasattr(mm, "madvise") and hasattr(mmap, "MADV_DONTNEED"):
+        start -= start % mmap.ALLOCATIONGRANULARITY
+        mm.madvise(mmap.MADV_DONTNEED, start, stop - start)
+
+
+def aq_reader_mmap(path, verbose = True):
+
+    """
+    Memory-mapped form of aq_reader for very large exports, returning the same dictionary. The
+    header is read from the mapped file up to the CSV column names, the lines after it are
+    counted to preallocate the timestamp and value arrays, and the rows are then parsed straight
+    from the mapped bytes in READ_CHUNK sized pieces. The file is never copied into memory as
+    bytes or strings, so peak memory is the output arrays plus one chunk.
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            aq_header([], verbose)
+        with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as mm:
+
+            ## Header lines up to and including the CSV column names
+            header = []
+            pos = 0
+            while pos < len(mm) and mm[pos:pos + 1] == b"#":
+                end = mm.find(b"\n", pos)
+                end = len(mm) if end < 0 else end + 1
+                header.append(mm[pos:end].decode("utf-8", "replace"))
+                pos = end
+            data_dict = aq_header(header, verbose)
+            if mm[pos:pos + 3] == b"ISO":
+                end = mm.find(b"\n", pos)
+                pos = len(mm) if end < 0 else end + 1
+
+            ## One row per line at most, the last line of a chunk may lack its newline
+            rows = 0
+            for lo, hi in mmap_chunks(mm, pos):
+                rows += int(np.count_nonzero(np.frombuffer(mm, dtype = np.uint8, count = hi - lo,
+                    offset = lo) == ord("\n"))) + 1
+                release_pages(mm, lo, hi)
+
+            timestamps = np.empty(rows, dtype = "datetime64[s]")
+            values = np.empty(rows, dtype = np.float64)
+            quality = []
+            n = 0
+            for lo, hi in mmap_chunks(mm, pos):
+                chunk_ts, chunk_vals, chunk_quality = parse_aq_rows(np.frombuffer(mm,
+                    dtype = np.uint8, count = hi - lo, offset = lo))
+                timestamps[n:n + len(chunk_ts)] = chunk_ts
+                values[n:n + len(chunk_vals)] = chunk_vals
+                quality.append(chunk_quality)
+                n += len(chunk_ts)
+                release_pages(mm, lo, hi)
+
+    data_dict["timestamps"] = timestamps[:n]
+    data_dict["values"] = values[:n]
+    data_dict["quality"] = merge_quality(quality)
+
+    return data_dict
+
+
+def aq_reader_stream(f, verbose = True):
+
+    """
+    Form of aq_reader for a binary stream, such as a decompressed export or a zip member,
+    returning the same dictionary. Data rows are parsed READ_CHUNK bytes at a time as they are
+    read, so the stream is never held in memory whole.
+    """
+    header, rest = stream_header(f)
+    data_dict = aq_header(header, verbose)
+
+    timestamps, values, quality = [], [], []
+    for chunk_ts, chunk_vals, chunk_quality in row_chunks(f, rest):
+        timestamps.append(chunk_ts)
+        values.append(chunk_vals)
+        quality.append(chunk_quality)
+
+    data_dict["timestamps"] = np.concatenate(timestamps or [np.zeros(0, dtype = "datetime64[s]")])
+    data_dict["values"] = np.concatenate(values or [np.zeros(0)])
+    data_dict["quality"] = merge_quality(quality)
+
+    return data_dict
+
+
+def stream_header(f):
+    """
+    Reads the header lines of an AQUARIUS export from a binary stream, up to and including the
+    CSV column names. Returns the header lines and the bytes read past them, the first data row
+    when the column names are missing.
+    """
+    header = []
+    line = f.readline()
+    while line.startswith(b"#"):
+        header.append(line.decode("utf-8", "replace"))
+        line = f.readline()
+
+    return header, b"" if line.startswith(b"ISO") else line
+
+
+def row_chunks(f, rest = b""):
+    """
+    Yields the (timestamps, values, quality) of parse_aq_rows for the data rows of a binary
+    stream read past its header, READ_CHUNK bytes at a time. rest is the bytes read before the
+    stream position, from stream_header.
+    """
+    while True:
+        block = f.read(READ_CHUNK)
+        data = rest + block
+        ## Only whole lines are parsed, the partial last line waits for the next block
+        cut = data.rfind(b"\n") + 1 if block else len(data)
+        data, rest = data[:cut], data[cut:]
+        if data:
+            yield parse_aq_rows(data)
+        if not block:
+            return
+
+
+def read_source(source, verbose = True):
+    """
+    Reads an AQUARIUS source from aquarius_sources.find_sources - a .csv file with aq_reader,
+    anything compressed or archived as a stream with aq_reader_stream.
+    """
+    if is_plain(source):
+        return aq_reader(source, verbose)
+    with open_source(source) as f:
+        return aq_reader_stream(f, verbose)
+
+
+def source_header(source):
+    """
+    Returns the header dictionary of an AQUARIUS source, reading no further than its header.
+    """
+    header = []
+    with open_source(source) as f:
+        for line in f:
+            if not line.startswith(b"#"):
+                break
+            header.append(line.decode("utf-8", "replace"))
+
+    return aq_header(header, verbose = False)
+
+
+def snap_config(tolerance = 0, policy = "first"):
+    """
+    Returns the dictionary describing how timestamps are snapped to slots that is handed to
+    align_values. tolerance is the largest distance in minutes (fractions allowed) between a
+    timestamp and its slot, 0 for exact matches only. policy is one of SNAP_POLICIES.
+    """
+    if policy not in SNAP_POLICIES:
+        raise ValueError("Unknown snap policy " + policy)
+
+    return {"tolerance" : int(round(tolerance * 60)), "policy" : policy}
+
+
+def slot_index(dt_range, timestamps, tolerance = 0):
+
+    """
+    Accepts the full datetime range and the timestamps from an AQUARIUS file and returns
+    the index of the nearest slot of the datetime range to each timestamp, a boolean mask that
+    is True where that slot is no more than tolerance seconds away, and the distance in seconds.
+    """
+    grid = np.asarray(dt_range, dtype = "datetime64[s]")
+    stamps = np.asarray(timestamps, dtype = "datetime64[s]")
+    if not len(grid):
+        return (np.zeros(len(stamps), dtype = np.intp), np.zeros(len(stamps), dtype = bool),
+                np.zeros(len(stamps), dtype = np.int64))
+
+    ## Binary search of each timestamp in the sorted datetime range, then the closer of the
+    ## slots either side of it
+    idx = np.searchsorted(grid, stamps)
+    after = np.minimum(idx, len(grid) - 1)
+    before = np.maximum(idx - 1, 0)
+    to_after = np.abs((grid[after] - stamps).astype(np.int64))
+    to_before = np.abs((stamps - grid[before]).astype(np.int64))
+    use_before = to_before < to_after
+    idx = np.where(use_before, before, after)
+    distance = np.where(use_before, to_before, to_after)
+
+    return idx, distance <= tolerance, distance
+
+
+def align_values(dt_range, timestamps, values, snap = None):
+
+    """
+    Places AQUARIUS values into a np.nan array the length of the full datetime range. Each
+    timestamp is snapped to its nearest slot within the tolerance of snap (a snap_config,
+    exact matches when None) and rows further from every slot are dropped. When several rows
+    collide on one slot the snap policy decides the value: "first" keeps the first row in the
+    file, "nearest" the row closest to the slot and "mean" the mean of the rows. Returns the
+    aligned array and the number of rows dropped and collided.
+    """
+    snap = snap or snap_config()
+    idx, matched, distance = slot_index(dt_range, timestamps, snap["tolerance"])
+    vals_perf = np.full(len(dt_range), np.nan)
+    slots = idx[matched]
+    values = np.asarray(values)[matched].astype(float)
+
+    if snap["policy"] == "mean":
+        present = ~np.isnan(values)
+        total = np.bincount(slots[present], weights = values[present], minlength = len(dt_range))
+        count = np.bincount(slots[present], minlength = len(dt_range))
+        hit = count > 0
+        vals_perf[hit] = total[hit] / count[hit]
+        unique = len(np.unique(slots))
+    else:
+        unique, rows = pick_rows(slots, distance[matched], snap["policy"])
+        vals_perf[unique] = values[rows]
+        unique = len(unique)
+
+    dropped = int(len(matched) - matched.sum())
+    collided = int(matched.sum() - unique)
+
+    return vals_perf, dropped, collided
+
+
+def pick_rows(slots, distance, policy):
+
+    """
+    Accepts the slot and distance of each matched row and returns the distinct slots with the
+    row that supplies each: the first row in the file, or under "nearest" the row closest to
+    the slot.
+    """
+    ## np.unique returns the first occurrence of each slot, after sorting by distance
+    ## for "nearest", so collisions resolve the same way every run
+    order = np.arange(len(slots))
+    if policy == "nearest":
+        order = np.lexsort((order, distance, slots))
+    unique, first = np.unique(slots[order], return_index = True)
+
+    return unique, order[first]
+
+
+def align_quality(dt_range, timestamps, quality, snap = None):
+
+    """
+    Places the quality codes of the rows of an AQUARIUS file on the full datetime range the way
+    align_values places its values. A slot takes the codes of the row that supplies its value,
+    the first row of the slot under the "mean" policy, and NO_CODE when no row lands on it.
+    Returns {field : (categories, codes)} like parse_aq_rows.
+    """
+    snap = snap or snap_config()
+    idx, matched, distance = slot_index(dt_range, timestamps, snap["tolerance"])
+    policy = "first" if snap["policy"] == "mean" else snap["policy"]
+    unique, rows = pick_rows(idx[matched], distance[matched], policy)
+    rows = np.flatnonzero(matched)[rows]
+
+    aligned = {}
+    for field, (categories, codes) in quality.items():
+        slot_codes = np.full(len(dt_range), NO_CODE, dtype = np.int16)
+        slot_codes[unique] = codes[rows]
+        aligned[field] = (categories, slot_codes)
+
+    return aligned
+
+
+def param_column(param):
+
+    """
+    Returns the gage_dict column filled by an AQUARIUS "Value parameter", or None when the
+    parameter is not in the PARAMETERS registry.
+    """
+    entry = PARAM_INDEX.get(param)
+
+    return None if entry is None else entry["column"]
+
+
+def fill_empties(gage_dict, data_dict, verbose = True, snap = None):
+
+    """
+    Input arguments are the empty gage_dict created by the empty_data function and the data_dict
+    returned from the aq_reader. Parameter values from the aq_reader data_dict are inserted
+    in place of the np.nan values that exist in the gage_dict and amended gage_dict is returned.
+    Only the slots the file has a value for are written, so when several files fill one
+    parameter, in planned source order, a later file's values replace an earlier one's and the
+    rest are kept - the same merge --update and time ranges make. Timestamps are snapped to
+    slots as described by snap, a snap_config. The quality codes of the parameter are kept
+    under gage_dict["quality"][column] as {field : (categories, codes)}.
+    """
+
+    ## Each timestamp is looked up by its index in the full datetime range rather than
+    ## scanning the range for every row. Files from ingest_file arrive already aligned.
+    if "aligned" in data_dict:
+        vals_perf = data_dict["aligned"]
+        dropped, collided = data_dict["dropped"], data_dict["collided"]
+        quality = data_dict.get("aligned_quality")
+    else:
+        vals_perf, dropped, collided = align_values(gage_dict["dt_range"],
+                data_dict["timestamps"], data_dict["values"], snap)
+        quality = None
+        if "quality" in data_dict:
+            quality = align_quality(gage_dict["dt_range"], data_dict["timestamps"],
+                    data_dict["quality"], snap)
+
+    if dropped and verbose:
+        print(data_dict["param"] + " rows off grid or outside water year : " + str(dropped))
+    if collided and verbose:
+        print(data_dict["param"] + " rows collided on a slot : " + str(collided))
+    
+    ## Determining parameter from header information in AQUARIUS file dictionary
+    ## Populating np.nan array as necessary
+    column = param_column(data_dict["param"])
+
+    ## Files from ingest_file carry the statistics accumulated while they were aligned
+    if "stats" in data_dict:
+        stats = finish_stats(data_dict["stats"], len(vals_perf))
+    else:
+        stats = summarize(vals_perf, gage_dict["dt_range"])
+    if column is not None:
+        ## Written into the shared table rather than replacing the column
+        present = ~np.isnan(vals_perf)
+        merged = column in gage_dict.get("stats", {})
+        gage_dict[column][present] = vals_perf[present]
+        gage_dict.setdefault("units", {})[column] = data_dict.get("units", "")
+        ## Kept so plot does not compute them again, computed again when an earlier file
+        ## filled the column too
+        if merged:
+            stats = summarize(gage_dict[column], gage_dict["dt_range"])
+        gage_dict.setdefault("stats", {})[column] = stats
+        if quality is not None:
+            stored = gage_dict.setdefault("quality", {})
+            stored[column] = replace_quality(stored.get(column), quality)
+    
+    ## Printing desired stats
+
+    if verbose:
+        print(data_dict["param"] + " Mean : " + str(stats["mean"]))
+        print(data_dict["param"] + " Min : " + str(stats["min"]))
+        print(data_dict["param"] + " Max : " + str(stats["max"]))
+    
+    ## Updated dictionary
+    return gage_dict
+
+
+def replace_quality(stored, new):
+
+    """
+    Returns the quality codes of a column with every slot new codes are given for (not NO_CODE)
+    taken from new and the rest from stored, which may be None. Both sets of categories are
+    combined and the codes renumbered to match.
+    """
+    quality = {}
+    for field, (categories, codes) in new.items():
+        old_categories, old_codes = stored[field] if stored and field in stored else \
+                ([], np.full(len(codes), NO_CODE, dtype = np.int16))
+        merged = sorted(set(old_categories) | set(categories))
+        lookup = {text : i for i, text in enumerate(merged)}
+
+        ## A trailing NO_CODE entry keeps NO_CODE (-1) as it is
+        renumber = lambda names, c : np.array([lookup[text] for text in names] + [NO_CODE],
+                dtype = np.int16)[c]
+        quality[field] = (merged, np.where(codes != NO_CODE, renumber(categories, codes),
+            renumber(old_categories, old_codes)).astype(np.int16))
+
+    return quality
+
+
+def ingest_file(path, dt_range, cache = None, snap = None, station = None, profile = False):
+
+    """
+    Reads and aligns a single AQUARIUS source so it can be run in a worker process. Returns the
+    header information with the values aligned to dt_range under "aligned" and the quality codes
+    under "aligned_quality" in place of the raw timestamps, values and quality. Any error is
+    returned under "error" rather than raised so one bad file does not stop the others. When a
+    cache from cache_config is given, unchanged files are loaded from it instead of being parsed
+    again. Timestamps are snapped to slots as described by snap, a snap_config. When station is
+    given, sources whose header names another station are not read and the reason is returned
+    under "skipped". With profile the stage records of the file are returned under "profile" for
+    the parent process to emit. Statistics of the aligned values are returned under "stats" as
+    an accumulator from aquarius_stats.
+    """
+    if profile:
+        with collect() as records:
+            result = ingest_file(path, dt_range, cache, snap, station)
+        result["profile"] = records
+        return result
+
+    try:
+        if station is not None:
+            found = source_header(path)["station"]
+            if found != station:
+                return {"path" : path, "skipped" : "station " + found + " is not " + station}
+        with stage("read", path) as record:
+            data_dict = None
+            if cache is not None:
+                data_dict = cache_lookup(cache, path)
+            if data_dict is None:
+                data_dict = read_source(path, verbose = False)
+                if cache is not None:
+                    cache_store(cache, path, data_dict)
+            record["rows"] = len(data_dict["values"])
+        with stage("align", path, len(data_dict["values"])):
+            timestamps = data_dict.pop("timestamps")
+            aligned, dropped, collided = align_values(dt_range, timestamps,
+                    data_dict.pop("values"), snap)
+            aligned_quality = align_quality(dt_range, timestamps, data_dict.pop("quality"), snap)
+            stats = update_stats(new_stats(), dt_range, aligned)
+    except Exception as err:
+        return {"path" : path, "error" : str(err) or type(err).__name__}
+
+    data_dict.update({"path" : path, "aligned" : aligned, "aligned_quality" : aligned_quality,
+        "dropped" : dropped, "collided" : collided, "stats" : stats})
+
+    return data_dict
+
+
+def ingest_files(paths, dt_range, jobs = 1, cache = None, snap = None, station = None):
+
+    """
+    Runs ingest_file over a list of AQUARIUS sources, in a pool of jobs processes when jobs is 
+    greater than 1, so the members of a zip archive are read in parallel like separate files.
+    Results are returned in the same order as paths regardless of which source finishes first.
+    """
+    ## datetime64 travels to worker processes far cheaper than datetime objects
+    grid = np.asarray(dt_range, dtype = "datetime64[m]")
+
+    if jobs <= 1 or len(paths) <= 1:
+        return [ingest_file(path, grid, cache, snap, station) for path in paths]
+
+    ## Stage hooks live in this process, so workers send their records back with the result
+    with ProcessPoolExecutor(max_workers = min(jobs, len(paths))) as executor:
+        results = list(executor.map(ingest_file, paths, repeat(grid), repeat(worker_cache(cache)),
+            repeat(snap), repeat(station), repeat(enabled())))
+
+    for result in results:
+        for record in result.pop("profile", []):
+            emit(record)
+
+    return results
+
+
+def time_cols(dt_range):
+    """
+    Accepts the datetime range produced by the full_dt_range function and returns 
+    a dictionary with an np.array for date, time, and minutes as needed for the the SD1 file.
+    Date is formatted as %m/%d/%y, time as %H:%M and minutes is the minute of the day.
+    """
+    dt = np.asarray(dt_range, dtype = "datetime64[m]")
+
+    ## Calendar fields by datetime64 arithmetic rather than strftime for every slot
+    days = dt.astype("datetime64[D]")
+    months = days.astype("datetime64[M]")
+    mins = (dt - days).astype(np.int64)
+    day = (days - months).astype(np.int64) + 1
+    month = months.astype(np.int64) % 12 + 1
+    year = months.astype(np.int64) // 12 + 1970
+
+    date = np.char.add(np.char.add(np.char.add(np.char.add(TWO_DIGITS[month], "/"), 
+        TWO_DIGITS[day]), "/"), TWO_DIGITS[year % 100])
+    time = np.char.add(np.char.add(TWO_DIGITS[mins // 60], ":"), TWO_DIGITS[mins % 60])
+    
+    ## Dictionary for time columns as per SD1 file
+    time_dict= {"date" : date, "time": time, "mins": mins}
+    
+    return time_dict
+
+
+@lru_cache(maxsize = 32)
+def year_grid(wtr_yr, interval = 15):
+    """
+    Returns the datetime range and the SD1 time columns for a water year. Grids are built once
+    per (water year, interval) and shared by every station processed for that year, so their
+    arrays are read only.
+    """
+    with stage("time_grid", str(wtr_yr)) as record:
+        dt_range = full_dt_range(wtr_yr, interval)
+        time_dict = time_cols(dt_range)
+        record["rows"] = len(dt_range)
+
+    for array in [dt_range] + list(time_dict.values()):
+        array.setflags(write = False)
+
+    return dt_range, time_dict
+
+
+def writetocsv(gage_dict, data_dict, time_dict, path):
+    """
+    Writes all data manipulated to a final .csv file. Required arguments include the updated gage_dict
+    with updated parameter data, a single parameter data_dict(any) to populate the station information,
+    the time_dict created in the time_cols function, and a filepath to the desired output file.
+    A path ending in .gz is written gzip compressed.
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "wb") as f:
+        
+        ## Header row per SD1 example
+        f.write(csv_line(sd1_header(gage_dict)).encode("utf-8"))
+        
+        ## Writing data to file
+        write_rows(f, gage_dict, data_dict, time_dict, 0, len(gage_dict["dt_range"]))
+
+
+def sd1_header(gage_dict):
+    """
+    Returns the SD1 .csv column names, followed by a <column>_qa flag column per parameter when
+    the gage_dict holds QA flags.
+    """
+    header = SD1_HEADER + [entry["header"] for entry in PARAMETERS]
+    if "flags" in gage_dict:
+        header += [entry["column"] + "_qa" for entry in PARAMETERS]
+
+    return header
+
+
+def csv_line(fields):
+    """
+    Returns one line of .csv text quoted and terminated the way csv.writer writes it.
+    """
+    text = io.StringIO()
+    csv.writer(text).writerow(fields)
+
+    return text.getvalue()
+
+
+def write_rows(f, gage_dict, data_dict, time_dict, start, stop):
+
+    """
+    Writes SD1 rows start to stop to the binary file f in blocks of WRITE_BLOCK rows. Each block
+    is formatted column by column rather than cell by cell, producing the same text csv.writer 
+    gives for the same values, including "nan" for missing values. QA flags, when the gage_dict
+    holds them, follow the values as integers.
+    """
+    ## Station columns are the same on every row so they are formatted once
+    prefix = csv_line([data_dict["station"], data_dict["name"], 
+        data_dict["name"].split(" ")[0]]).rstrip("\r\n") + ","
+    width = len(PARAMETERS)
+
+    for lo in range(start, stop, WRITE_BLOCK):
+        hi = min(lo + WRITE_BLOCK, stop)
+
+        ## Date, Time, Mins, DT ("YYYY-mm-dd HH:MM:SS") and the empty DT2 column
+        dt_text = np.char.replace(np.datetime_as_string(
+            np.asarray(gage_dict["dt_range"][lo:hi], dtype = "datetime64[s]")), "T", " ")
+        heads = [prefix + ",".join(fields) + ",," for fields in zip(
+            np.asarray(time_dict["date"][lo:hi]).tolist(), 
+            np.asarray(time_dict["time"][lo:hi]).tolist(),
+            np.asarray(time_dict["mins"][lo:hi]).astype(str).tolist(), dt_text.tolist())]
+
+        ## repr of a Python float is the same shortest text str gives a float64, other
+        ## dtypes go through numpy so float32 keeps its own shortest text
+        values = np.column_stack([gage_dict[entry["column"]][lo:hi] for entry in PARAMETERS])
+        if values.dtype == np.float64:
+            text = list(map(repr, values.ravel().tolist()))
+        else:
+            text = values.astype(str).ravel().tolist()
+
+        lines = [head + ",".join(text[i * width:(i + 1) * width]) for i, head in enumerate(heads)]
+        if "flags" in gage_dict:
+            flags = np.column_stack([gage_dict["flags"][entry["column"]][lo:hi]
+                for entry in PARAMETERS]).astype(str).tolist()
+            lines = [line + "," + ",".join(row) for line, row in zip(lines, flags)]
+        f.write(("\r\n".join(lines) + "\r\n").encode("utf-8"))
+
+
+def station_stats(gage_dict):
+    """
+    Returns the summary statistics of every parameter column, reusing those stored by
+    fill_empties and computing the rest from the column.
+    """
+    stats = gage_dict.get("stats", {})
+
+    return {param : stats.get(param) or summarize(gage_dict[param], gage_dict["dt_range"])
+            for param in SD1_PARAMS}
+
+
+def summary_path(out):
+    """
+    Returns the JSON summary file written alongside an SD1 output - ex. licking_river.summary.json
+    """
+    if out.endswith(".gz"):
+        out = out[:-len(".gz")]
+    return os.path.splitext(out)[0] + ".summary.json"
@@ -0,0 +1,191 @@
+from contextlib import contextmanager, nullcontext
+import io
+import json
+import os
+import pstats
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    ## Not available on Windows, peak memory is then only reported under tracemalloc
+    resource = None
+
+## Functions called with the record of every finished stage. Stages are only timed while
+## at least one hook is registered, otherwise stage() hands back a no-op.
+HOOKS = []
+
+
+def add_hook(hook):
+    """
+    Registers a function called with the record dictionary of each finished stage.
+    """
+    HOOKS.append(hook)
+
+
+def remove_hook(hook):
+    """
+    Unregisters a function added with add_hook.
+    """
+    HOOKS.remove(hook)
+
+
+def enabled():
+    """
+    Returns True when stages are being recorded.
+    """
+    return bool(HOOKS)
+
+
+def emit(record):
+    """
+    Passes a finished stage record to every hook.
+    """
+    for hook in list(HOOKS):
+        hook(record)
+
+
+def peak_bytes():
+    """
+    Returns the peak of Python allocations in bytes since the last tracemalloc.reset_peak, or
+    None when tracemalloc is not tracing.
+    """
+    if tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()[1]
+
+    return None
+
+
+def max_rss():
+    """
+    Returns the largest resident size of the process so far in bytes, None where the platform
+    does not report it. It only ever grows, so stages are given how much they raised it.
+    """
+    if resource is not None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    return None
+
+
+@contextmanager
+def timed_stage(name, item, rows):
+    """
+    Times the body of a with block and emits its record when the block ends.
+    """
+    record = {"stage" : name, "item" : item, "rows" : rows, "pid" : os.getpid()}
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    rss = max_rss()
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record["seconds"] = time.perf_counter() - start
+        record["peak_bytes"] = peak_bytes()
+        record["rss_growth_bytes"] = None if rss is None else max_rss() - rss
+        emit(record)
+
+
+def stage(name, item = None, rows = None):
+
+    """
+    Context manager around one pipeline stage - ex. with stage("read", path) as record: ...
+    The record dictionary it returns can be given the rows processed by the stage under "rows".
+    Records hold stage, item, rows, seconds, peak_bytes (the peak of Python allocations during
+    the stage, under tracemalloc only), rss_growth_bytes (how far the stage raised the largest
+    resident size of the process) and pid. When no hook is registered nothing is timed and the
+    record is a throwaway dictionary.
+    """
+    if not HOOKS:
+        return nullcontext({})
+
+    return timed_stage(name, item, rows)
+
+
+@contextmanager
+def collect():
+    """
+    Records stages into a list for the length of a with block, used in worker processes so the
+    records can be sent back to the parent and passed to its hooks with emit.
+    """
+    records = []
+    add_hook(records.append)
+    try:
+        yield records
+    finally:
+        remove_hook(records.append)
+
+
+def report_table(records):
+
+    """
+    Returns the stage records as a text table followed by the total of each stage. Peak MB is
+    the stage's peak of Python allocations (with tracemalloc), Max RSS +MB how far it raised the
+    largest resident size of the process.
+    """
+    headers = ("Stage", "Item", "Rows", "Seconds", "Rows/s", "Peak MB", "Max RSS +MB")
+    rows = []
+    totals = {}
+    for record in records:
+        growth = record.get("rss_growth_bytes")
+        rows.append(format_row(record["stage"], record["item"], record["rows"], record["seconds"],
+            record["peak_bytes"], growth))
+        total = totals.setdefault(record["stage"], [0, 0.0, None, None])
+        total[0] += record["rows"] or 0
+        total[1] += record["seconds"]
+        if record["peak_bytes"] is not None:
+            total[2] = max(total[2] or 0, record["peak_bytes"])
+        if growth is not None:
+            total[3] = (total[3] or 0) + growth
+
+    rows.append(("",) * len(headers))
+    for name, (count, seconds, peak, growth) in totals.items():
+        rows.append(format_row(name, "total", count or None, seconds, peak, growth))
+
+    widths = [max(len(item) for item in col) for col in zip(headers, *rows)]
+    lines = ["  ".join(item.ljust(width) for item, width in zip(row, widths)).rstrip()
+            for row in [headers] + rows]
+
+    return "\n".join(lines)
+
+
+def format_row(name, item, rows, seconds, peak, growth):
+    """
+    Formats one line of report_table.
+    """
+    megabytes = lambda size : "" if size is None else "%.1f" % (size / 1048576.0)
+
+    return (name, os.path.basename(item) if item else "", "" if rows is None else str(rows),
+            "%.4f" % seconds, "%.0f" % (rows / seconds) if rows and seconds else "",
+            megabytes(peak), megabytes(growth))
+
+
+def report_json(records):
+    """
+    Returns the stage records as a JSON string.
+    """
+    return json.dumps({"stages" : records}, indent = 1)
+
+
+def write_cprofile(profiler, path, top = 25):
+    """
+    Saves cProfile statistics to path and returns the top functions by cumulative time as text.
+    """
+    profiler.dump_stats(path)
+    text = io.StringIO()
+    pstats.Stats(profiler, stream = text).sort_stats("cumulative").print_stats(top)
+
+    return text.getvalue()
+
+
+def tracemalloc_top(top = 10):
+    """
+    Returns the source lines holding the most traced memory as text.
+    """
+    snapshot = tracemalloc.take_snapshot()
+    lines = ["Top " + str(top) + " allocation sites"]
+    for stat in snapshot.statistics("lineno")[:top]:
+        lines.append(str(stat))
+
+    return "\n".join(lines)
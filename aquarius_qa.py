@@ -0,0 +1,76 @@
+import numpy as np
+
+## Bits of the QA flag of a slot, combined with | when a value fails several checks
+RANGE = 1
+SPIKE = 2
+FLATLINE = 4
+
+FLAG_NAMES = {RANGE : "range", SPIKE : "spike", FLATLINE : "flatline"}
+
+
+def grid_minutes(dt_range):
+    """
+    Returns the minutes between slots of a datetime range, 15 when it has fewer than two slots.
+    """
+    if len(dt_range) < 2:
+        return 15
+    return int((np.datetime64(dt_range[1], "m") - np.datetime64(dt_range[0], "m")).astype(np.int64))
+
+
+def qa_flags(values, rules, minutes = 15):
+
+    """
+    Returns the uint8 QA flag bitmask of each slot of a series on a grid of minutes between
+    slots, 0 where every check passes or the value is missing. rules is the "qa" entry of a
+    PARAMETERS registry entry:
+    min / max - values outside the range are flagged RANGE
+    spike - a value that rises above both neighbours (or falls below them) by more than spike
+        is flagged SPIKE
+    flat_minutes - runs of the same value lasting at least flat_minutes are flagged FLATLINE
+    A rule of None skips its check. Each check is a few whole array operations.
+    """
+    values = np.asarray(values, dtype = np.double)
+    flags = np.zeros(len(values), dtype = np.uint8)
+    if not len(values):
+        return flags
+
+    ## np.nan compares False, so missing values are never flagged
+    with np.errstate(invalid = "ignore"):
+        if rules.get("min") is not None:
+            flags[values < rules["min"]] |= RANGE
+        if rules.get("max") is not None:
+            flags[values > rules["max"]] |= RANGE
+
+        if rules.get("spike") is not None and len(values) > 2:
+            rise = values[1:-1] - values[:-2]
+            fall = values[2:] - values[1:-1]
+            spike = (np.abs(rise) > rules["spike"]) & (np.abs(fall) > rules["spike"]) & \
+                    (np.sign(rise) != np.sign(fall))
+            flags[1:-1][spike] |= SPIKE
+
+    if rules.get("flat_minutes") is not None:
+        ## Runs of equal neighbours, each slot flagged when its run is long enough
+        starts = np.flatnonzero(np.concatenate(([True], values[1:] != values[:-1])))
+        lengths = np.diff(np.append(starts, len(values)))
+        flat = np.repeat(lengths * minutes >= rules["flat_minutes"], lengths)
+        flags[flat & ~np.isnan(values)] |= FLATLINE
+
+    return flags
+
+
+def station_flags(gage_dict, parameters):
+    """
+    Returns the QA flags of every parameter column of a gage_dict, keyed by column. parameters
+    is the PARAMETERS registry.
+    """
+    minutes = grid_minutes(gage_dict["dt_range"])
+
+    return {entry["column"] : qa_flags(gage_dict[entry["column"]], entry["qa"], minutes)
+            for entry in parameters if entry["column"] in gage_dict}
+
+
+def flag_counts(flags):
+    """
+    Returns the number of slots flagged by each check, keyed by check name.
+    """
+    return {name : int(np.count_nonzero(flags & bit)) for bit, name in FLAG_NAMES.items()}
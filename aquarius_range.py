@@ -0,0 +1,230 @@
+import gzip
+import numpy as np
+from aquarius_aggregate import AGGREGATE_RULES, aggregate, aggregate_path, write_aggregate
+from aquarius_catalog import SPAN_MARGIN, plan_sources, scan_headers
+from aquarius_core import (SD1_PARAMS, align_values, csv_line, empty_data,
+        param_column, print_header, row_chunks, sd1_header, snap_config, stream_header,
+        summary_path, time_cols, write_rows)
+from aquarius_profile import stage
+from aquarius_sources import find_sources, open_source
+from aquarius_stats import finish_stats, new_stats, update_stats, write_summary
+
+## Calendar months of the time range held in memory at once
+WINDOW_MONTHS = 12
+
+
+def range_slots(start, end, interval = 15):
+    """
+    Returns the number of slots of interval minutes from start up to but not including end.
+    """
+    return int(-((start - end) // np.timedelta64(interval, "m")))
+
+
+def window_bounds(start, end, interval = 15, months = WINDOW_MONTHS):
+
+    """
+    Splits the slots of a time range into windows of months calendar months and returns their
+    (first, stop) slot indexes. Windows break at the first slot of a month so no hour, day or
+    month of the aggregated products is split between two windows.
+    """
+    slots = range_slots(start, end, interval)
+    edges = [0]
+    month = start.astype("datetime64[M]") + months
+    while month.astype("datetime64[m]") < end:
+        edge = range_slots(start, month.astype("datetime64[m]"), interval)
+        if edges[-1] < edge < slots:
+            edges.append(edge)
+        month += months
+    edges.append(slots)
+
+    return list(zip(edges[:-1], edges[1:])) if slots else []
+
+
+def route_slots(timestamps, start, interval, slots, tolerance = 0):
+
+    """
+    Returns the slot of a time range nearest to each timestamp, picked the way slot_index picks
+    it on the whole range. Timestamps more than tolerance seconds before the range get -1 and
+    those more than tolerance seconds after it get slots.
+    """
+    step = interval * 60
+    offset = (np.asarray(timestamps, dtype = "datetime64[s]")
+            - start.astype("datetime64[s]")).astype(np.int64)
+    ## Nearest slot, a timestamp halfway between two slots going to the later one
+    idx = (2 * offset + step) // (2 * step)
+
+    last = (slots - 1) * step
+    idx[offset < 0] = np.where(-offset[offset < 0] <= tolerance, 0, -1)
+    idx[offset > last] = np.where(offset[offset > last] - last <= tolerance, slots - 1, slots)
+
+    return idx
+
+
+def open_rows(source):
+    """
+    Returns a generator of the (timestamps, values, quality) chunks of the data rows of an
+    AQUARIUS source. The source is opened on the first chunk and closed when it runs out or
+    the generator is closed.
+    """
+    with open_source(source) as f:
+        header, rest = stream_header(f)
+        yield from row_chunks(f, rest)
+
+
+def window_rows(state, first, stop, route):
+
+    """
+    Returns the timestamps and values of the rows of a source whose slot lies in first to stop,
+    reading its chunks only until a row of a later window arrives, which is kept in state for
+    that window. Rows before the range or before first, which arrive after their window is
+    written, are counted under state["dropped"]. Once a row lies beyond the range the rest of
+    the source is not read.
+    """
+    while not state["done"] and (not len(state["slots"]) or state["slots"][-1] < stop):
+        try:
+            timestamps, values, quality = next(state["chunks"])
+        except StopIteration:
+            state["done"] = True
+            break
+        slots = route(timestamps)
+        if np.any(slots == state["slots_total"]):
+            state["chunks"].close()
+            state["done"] = True
+        keep = (slots >= first) & (slots < state["slots_total"])
+        state["dropped"] += int(len(slots) - np.count_nonzero(keep))
+        state["timestamps"] = np.concatenate((state["timestamps"], timestamps[keep]))
+        state["values"] = np.concatenate((state["values"], values[keep]))
+        state["slots"] = np.concatenate((state["slots"], slots[keep]))
+
+    take = state["slots"] < stop
+    rows = state["timestamps"][take], state["values"][take]
+    for key in ("timestamps", "values", "slots"):
+        state[key] = state[key][~take]
+
+    return rows
+
+
+def process_range(start, end, loc, out, interval = 15, months = WINDOW_MONTHS, verbose = True,
+        dtype = np.double, aggregates = (), snap = None, station = None):
+
+    """
+    Builds the SD1 file of a station from start up to but not including end (datetime64[m])
+    in windows of months calendar months, so peak memory is set by the window rather than the
+    length of the range. For every window the sources are read only as far as its rows, aligned
+    to its slots, added to the running statistics and aggregated products, and written to the
+    end of the .csv before the next window is read. The sources are planned from their headers
+    like process_station and are read in time order, as AQUARIUS exports them. Where several
+    sources fill one parameter the values of a later source replace those of an earlier one
+    wherever it has a value, as fill_empties merges them. The output does not depend on months:
+    the .csv and aggregated products are the same as one window over the whole range gives, and
+    over a water year the same as process_station writes, and the statistics the same within
+    rounding. No figures are drawn. Returns the number of AQUARIUS sources processed and raises ValueError
+    when there are none.
+    """
+    snap = snap or snap_config()
+    slots = range_slots(start, end, interval)
+    step = np.timedelta64(interval, "m")
+
+    sources = find_sources(loc) if isinstance(loc, str) else sorted(loc)
+    with stage("scan_headers", loc if isinstance(loc, str) else None, len(sources)):
+        catalog = scan_headers(sources)
+    planned, skipped = plan_sources(catalog, np.array([start, end - step]), station)
+    if verbose:
+        for path, reason in skipped:
+            print("Skipping " + path + " : " + reason)
+
+    ## Station information comes from the headers, the last readable one as process_station
+    ## takes it from the last file
+    entries = dict((entry["source"], entry) for entry in catalog)
+    named = [entries[path] for path in planned if "error" not in entries[path]]
+    if not named:
+        raise ValueError("No AQUARIUS files processed in "
+                + (loc if isinstance(loc, str) else ", ".join(sources)))
+    data_dict = {"station" : named[-1]["station"], "name" : named[-1]["name"]}
+    if verbose:
+        print_header(data_dict["station"], data_dict["name"], ", ".join(sorted(set(
+            entry["units"] for entry in named))))
+
+    route = lambda timestamps : route_slots(timestamps, start, interval, slots, snap["tolerance"])
+    states = []
+    for path in planned:
+        entry = entries[path]
+        if "error" in entry:
+            print("Unable to process " + path + " : " + entry["error"])
+            continue
+        states.append({"path" : path, "entry" : entry, "chunks" : open_rows(path), "done" : False,
+            "slots_total" : slots, "timestamps" : np.zeros(0, dtype = "datetime64[s]"),
+            "values" : np.zeros(0), "slots" : np.zeros(0, dtype = np.int64), "dropped" : 0,
+            "collided" : 0, "failed" : False})
+
+    accumulators = {param : new_stats() for param in SD1_PARAMS}
+    units = {}
+    opener = gzip.open if out.endswith(".gz") else open
+    with opener(out, "wb") as f:
+        f.write(csv_line(sd1_header({})).encode("utf-8"))
+
+        for k, (first, stop) in enumerate(window_bounds(start, end, interval, months)):
+            dt_range = start + step * np.arange(first, stop)
+            with stage("window", str(dt_range[0]), len(dt_range)):
+                gage_dict = empty_data(dt_range, dtype)
+                for state in states:
+                    entry = state["entry"]
+                    ## Sources whose export starts after the window are not opened yet
+                    if state["failed"] or (entry.get("start") is not None and
+                            entry["start"] - SPAN_MARGIN > dt_range[-1]):
+                        continue
+                    try:
+                        timestamps, values = window_rows(state, first, stop, route)
+                    except Exception as err:
+                        print("Unable to process " + state["path"] + " : "
+                                + (str(err) or type(err).__name__))
+                        state["failed"] = True
+                        continue
+                    column = param_column(entry.get("param"))
+                    if column is None or not len(timestamps):
+                        continue
+                    aligned, dropped, collided = align_values(dt_range, timestamps, values, snap)
+                    state["dropped"] += dropped
+                    state["collided"] += collided
+                    present = ~np.isnan(aligned)
+                    gage_dict[column][present] = aligned[present]
+                    units[column] = entry["units"]
+
+                for param in SD1_PARAMS:
+                    accumulators[param] = update_stats(accumulators[param], dt_range,
+                            gage_dict[param])
+                for period in aggregates:
+                    labels, columns = aggregate(gage_dict["table"], dt_range, period,
+                            AGGREGATE_RULES)
+                    write_aggregate(aggregate_path(out, period), data_dict["station"], labels,
+                            columns, append = k > 0)
+                write_rows(f, gage_dict, data_dict, time_cols(dt_range), 0, len(dt_range))
+
+            if verbose:
+                print("Written " + str(dt_range[0]).replace("T", " ") + " to "
+                        + str(dt_range[-1]).replace("T", " "))
+
+    for state in states:
+        state["chunks"].close()
+    processed = sum(1 for state in states if not state["failed"])
+    if not processed:
+        raise ValueError("No AQUARIUS files processed in "
+                + (loc if isinstance(loc, str) else ", ".join(sources)))
+
+    stats = {param : finish_stats(accumulators[param], slots) for param in SD1_PARAMS}
+    if verbose:
+        for state in states:
+            param = state["entry"].get("param", state["path"])
+            if state["dropped"]:
+                print(param + " rows off grid or outside time range : " + str(state["dropped"]))
+            if state["collided"]:
+                print(param + " rows collided on a slot : " + str(state["collided"]))
+        for param in SD1_PARAMS:
+            if param in units:
+                print(param + " Mean : " + str(stats[param]["mean"]))
+                print(param + " Min : " + str(stats[param]["min"]))
+                print(param + " Max : " + str(stats[param]["max"]))
+    write_summary(summary_path(out), data_dict, None, stats,
+            (str(start).replace("T", " "), str(end).replace("T", " ")))
+
+    return processed
@@ -1,304 +1,314 @@
-from datetime import datetime, timedelta
 import numpy as np
+import argparse
+import cProfile
 import csv
-import glob
 import os
 import sys
-import matplotlib.pyplot as plt     
-
-def datetime_range(start, end, delta):
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from aquarius_aggregate import PERIODS
+from aquarius_cache import DEFAULT_CACHE_DIR, DEFAULT_CACHE_MB, cache_config
+from aquarius_catalog import SCAN_JOBS, print_catalog, scan_headers, write_catalog
+from aquarius_core import SNAP_POLICIES, parse_range, snap_config, year_grid
+from aquarius_profile import (add_hook, report_json, report_table, tracemalloc_top,
+        write_cprofile)
+from aquarius_sources import find_sources
+from aquarius_station import process_station, update_station
+
+
+def read_manifest(path):
     """
-    Creates full time series of interest.
+    Reads a batch manifest. Each line holds a station directory or zip archive, water year and
+    output file separated by commas - ex. licking_data/, 2018, licking_river.csv - and may end
+    with a station number so only that station's sources are used. Blank lines and lines
+    starting with # are skipped.
     """
-    
-    current = start
-    while current < end:
-        yield current
-        current += delta
+    manifest = []
+    with open(path, newline = "") as f:
+        for row in csv.reader(f):
+            if not row or not "".join(row).strip() or row[0].strip().startswith("#"):
+                continue
+            if len(row) not in (3, 4):
+                raise ValueError("Manifest line must be station directory, water year, output "
+                        "[, station] : " + ",".join(row))
+            loc, wtr_yr, out = (item.strip() for item in row[:3])
+            station = row[3].strip() or None if len(row) == 4 else None
+            manifest.append((loc, int(wtr_yr), out, station))
 
-def full_dt_range(wtr_yr):
-    """
-    Uses datetime_range to return a full datetime range list object with 15 minute
-    increments for a specific water year (10/1 to 9/30) determined by the only required argument
-    """
-    dt_range = []
-    
-    ## Water year (10/1 - 9/30) full range- 15 minute increments
-    dts = datetime_range(datetime(wtr_yr -1, 10,1, 0, 0, 0),
-        datetime(wtr_yr, 10, 1, 0, 0, 0),
-        timedelta(minutes = 15))
-    for dt in dts:
-        dt_range.append(dt)
-   
-    return dt_range     
+    return manifest
 
 
-def empty_data(dt_range):
+def run_batch(manifest, workers = 1, jobs = 1, cache = None, binary = False, update = False,
+        plots = True, dtype = np.double, aggregates = (), snap = None, interval = 15, qa = False):
 
     """
-    Accepts only a datetime range list argument returned in full_dt_range and returns
-    a dictionary with a key for each column needed in the SD1 file. Each key value is 
-    an np.array created with a length the same as the full datetime range
+    Runs process_station for every (station directory, water year, output, station) job of a
+    manifest in a pool of at most workers threads. The time grid of interval minutes for each
+    water year is built once and shared between jobs, and figures are saved next to each output
+    in <output>_figs. Returns a list of (loc, wtr_yr, out, status, seconds) rows in manifest
+    order.
     """
-    dt_range = np.asarray(dt_range)
-    
-    ## Numpy NaN arrays for each param equal in length to the datetime range
-    gageheight_ft = np.full_like(dt_range, np.nan, dtype = np.double)
-    discharge_cfs= np.full_like(dt_range, np.nan, dtype = np.double)
-    precip_in = np.full_like(dt_range, np.nan, dtype = np.double)
-    temp_c = np.full_like(dt_range, np.nan, dtype = np.double)
-    do_mgL = np.full_like(dt_range, np.nan, dtype = np.double)
-    pH_su = np.full_like(dt_range, np.nan, dtype = np.double)
-    conduct_umhos = np.full_like(dt_range, np.nan, dtype = np.double)
-    turb_ntu = np.full_like(dt_range, np.nan, dtype = np.double)
-    velocity = np.full_like(dt_range, np.nan, dtype = np.double)
-    nitrate = np.full_like(dt_range, np.nan, dtype = np.double)
-
-    ## Dictionary for datetime range and empty param arrays
-    empties = { "dt_range" : dt_range, "gageheight_ft" : gageheight_ft, 
-            "discharge_cfs" : discharge_cfs, "precip_in" : precip_in, 
-            "temp_c" : temp_c, "do_mgL" : do_mgL, "pH_su" : pH_su, 
-            "cond_umhos" : conduct_umhos, "turb_ntu" : turb_ntu, 
-            "velocity_ft_s" : velocity, "nitrate_mgL": nitrate} 
-
-    return empties
-
-
-def aq_reader(path):
-
+    grids = {}
+    for wtr_yr in sorted(set(job[1] for job in manifest)):
+        grids[wtr_yr] = year_grid(wtr_yr, interval)
+
+    def run_job(job):
+        loc, wtr_yr, out, station = job
+        start = time.perf_counter()
+        try:
+            if update:
+                counts = update_station(wtr_yr, loc, out, jobs, grids[wtr_yr],
+                        os.path.splitext(out)[0] + "_figs", False, cache, binary, plots, dtype,
+                        aggregates, snap, station, qa)
+                status = "ok (built)" if counts is None else \
+                        "ok (" + str(sum(counts.values())) + " slots changed)"
+            else:
+                processed = process_station(wtr_yr, loc, out, jobs, grids[wtr_yr],
+                        os.path.splitext(out)[0] + "_figs", False, cache, binary, plots, dtype,
+                        aggregates, snap, station, qa)
+                status = "ok (" + str(processed) + " files)"
+        except Exception as err:
+            status = "failed: " + (str(err) or type(err).__name__)
+        seconds = time.perf_counter() - start
+        print(loc + " " + str(wtr_yr) + " -> " + out + " : " + status)
+        return (loc, wtr_yr, out, status, seconds)
+
+    with ThreadPoolExecutor(max_workers = max(1, min(workers, len(manifest)))) as executor:
+        return list(executor.map(run_job, manifest))
+
+
+def print_summary(results):
     """
-    Accepts the filepath argument to an AQUARIUS .csv file and returns a dictionary with desired data
+    Prints the per job status and duration table for a batch run.
     """
-    with open(path) as f:
-        
-        timestamps = []
-        values = []
-        
-        ## Reading csv
-        lines = f.readlines() 
-        for line in lines:
-            if not line.startswith(("#", "ISO")):
-                values.append(line.split(",")[2])
-                timestamp =(line.split(",")[1])
-                ## Returning a datetime object from date string
-                timestamps.append(datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S"))
-        if "AQUARIUS" in lines[0]:
-
-            station = lines[0].split("@")[1][:8]
-            print(station)
-            name = lines[3].split(":")[1].split(",")[0].strip()
-            print(name)
-            param = lines[6].split(":")[1].split(",")[0].strip()
-            units = lines[5].split(":")[1].split(",")[0].strip()
-            print("Units : " + units) 
-            
-        else: 
-            print("WRONG FILE OR FORMAT!!!")
-    
-    ## Dictionary for AQUARIUS file
-    data_dict = {"station" : station, "name": name, "param": param, 
-            "timestamps": np.asarray(timestamps), "values": np.asarray(values)}
+    headers = ("Station directory", "Water year", "Output", "Status", "Seconds")
+    rows = [(loc, str(wtr_yr), out, status, "%.2f" % seconds) 
+            for loc, wtr_yr, out, status, seconds in results]
+    widths = [max(len(item) for item in col) for col in zip(headers, *rows)]
 
-    return data_dict
+    for row in [headers] + rows:
+        print("  ".join(item.ljust(width) for item, width in zip(row, widths)).rstrip())
 
+    failed = sum(1 for row in results if not row[3].startswith("ok"))
+    print(str(len(results)) + " jobs, " + str(failed) + " failed, " 
+            + "%.2f" % sum(row[4] for row in results) + " seconds")
 
-def fill_empties(gage_dict, data_dict):
 
+def water_year_or_range(text):
     """
-    Input arguments are the empty gage_dict created by the empty_data function and the data_dict
-    returned from the aq_reader. Parameter values from the aq_reader data_dict are inserted
-    in place of the np.nan values that exist in the gage_dict and amended gage_dict is returned.
+    Returns a water year as int, or the (start, end) of a START/END time range from parse_range.
     """
+    if text.isdigit():
+        return int(text)
 
-    dt_range = gage_dict["dt_range"]
-    values = data_dict["values"]
-    timestamps = data_dict["timestamps"]
-    vals_perf = []
-        
-    ## Loop that finds matching timestamps and inserts data based upon index 
-    ## in the full datetime range similar to excel VLOOKUP 
-    
-    for i in range(len(dt_range)):
-        vals_perf.append(np.NaN)
-        
-        for j in range(len(timestamps)):
-            if dt_range[i] == timestamps[j]:
-                #print(timestamps[j])
-                vals_perf[i] = values[j]
-                break
-
-    
-    vals_perf = np.asarray(vals_perf).astype(np.float)
-    
-    ## Determining parameter from header information in AQUARIUS file dictionary
-    ## Populating np.nan array as necessary
-
-    if data_dict["param"] == "Precipitation":
-        gage_dict["precip_in"] = vals_perf.astype(np.float)
-
-    if data_dict["param"] == "Gage height":
-        gage_dict["gageheight_ft"] = vals_perf.astype(np.float)
-    
-    if data_dict["param"] == "Discharge":
-        gage_dict["discharge_cfs"] = vals_perf.astype(np.float)
-    
-    if data_dict["param"] == "Temperature":
-        gage_dict["temp_c"] = vals_perf.astype(np.float)
-    
-    if data_dict["param"] == "Dissolved oxygen":
-        gage_dict["do_mgL"] = vals_perf.astype(np.float)
-    
-    if data_dict["param"] == "pH":
-        gage_dict["pH_su"] = vals_perf.astype(np.float)
-    
-    if data_dict["param"] == "Specific cond at 25C":
-        gage_dict["cond_umhos"] = vals_perf.astype(np.float)
-    
-    if data_dict["param"] == "Turbidity":
-        gage_dict["turb_ntu"] = vals_perf.astype(np.float)
-    
-    if data_dict["param"] == "Mean water velocity":
-        gage_dict["velocity_ft_s"] = vals_perf.astype(np.float)
-    
-    if data_dict["param"] == "NO3+NO2":
-        gage_dict["nitrate_mgL"] = vals_perf.astype(np.float)
-    
-    ## Printing desired stats
-
-    print(data_dict["param"] + " Mean : " + str(np.nanmean(vals_perf)))
-    print(data_dict["param"] + " Min : " + str(np.nanmin(vals_perf)))
-    print(data_dict["param"] + " Max : " + str(np.nanmax(vals_perf)))
-    
-    ## Updated dictionary
-    return gage_dict
+    return parse_range(text)
 
 
-def time_cols(dt_range):
+def parse_args(argv = None):
     """
-    Accepts the datetime range list produced by the full_dt_range function and returns 
-    a dictionary with an np.array for date, time, and minutes as needed for the the SD1 file.
+    Command line arguments - water year, location of the AQUARIUS files and output file name,
+    or a batch manifest in place of all three
     """
-    date = []
-    time = []
-    mins = []
-    mins_val = 0
-    for dt in dt_range:
-        date.append(dt.strftime("%m/%d/%y"))
-        time.append(dt.strftime("%H:%M"))
-
-        ## Creating an array filled with 15 min increments
-        mins.append(mins_val)
-        if mins_val < 1425:
-            mins_val += 15
-        else:
-            mins_val = 0
- 
-    for item in date, time, mins:
-        item = np.asarray(item)
-    
-    ## Dictionary for time columns as per SD1 file
-    time_dict= {"date" : date, "time": time, "mins": mins}
-    
-    return time_dict
+    parser = argparse.ArgumentParser(description = "Compile AQUARIUS .csv files into an SD1 .csv file")
+    parser.add_argument("wtr_yr", type = water_year_or_range, nargs = "?",
+            help = "water year of the data - ex. 2018 - or a time range START/END processed in "
+            "windows of --window months - ex. 2001-10-01/2021-10-01")
+    parser.add_argument("loc", nargs = "?", help = "location of the AQUARIUS files - ex. licking_data/ "
+            "(.csv, .csv.gz, .csv.bz2, .csv.xz and .zip archives are read, or a single .zip)")
+    parser.add_argument("out", nargs = "?", help = "name of the output .csv file - ex. licking_river.csv")
+    parser.add_argument("--jobs", type = int, default = 1, metavar = "N",
+            help = "number of processes used to read the AQUARIUS files (default 1)")
+    parser.add_argument("--window", type = int, default = 12, metavar = "MONTHS",
+            help = "months of a time range held in memory at once (default 12)")
+    parser.add_argument("--batch", metavar = "MANIFEST",
+            help = "run every station directory, water year, output line of MANIFEST")
+    parser.add_argument("--workers", type = int, default = os.cpu_count() or 1, metavar = "N",
+            help = "number of batch jobs run at once (default number of CPUs)")
+    parser.add_argument("--binary", action = "store_true",
+            help = "also write the gage table as a columnar binary bundle <output>.sd1")
+    parser.add_argument("--float32", action = "store_true",
+            help = "hold the gage table as float32, halving its memory (values are written at "
+            "float32 precision)")
+    parser.add_argument("--no-plot", action = "store_true",
+            help = "skip the figures, for headless pipeline runs")
+    parser.add_argument("--aggregate", nargs = "+", choices = list(PERIODS), default = [],
+            metavar = "PERIOD", help = "also write hourly, daily and/or monthly products "
+            "<output>.<period>.csv")
+    parser.add_argument("--interval", type = int, default = 15, metavar = "MIN",
+            help = "minutes between slots of the time grid (default 15)")
+    parser.add_argument("--tolerance", type = float, default = 0, metavar = "MIN",
+            help = "snap timestamps up to MIN minutes from a slot onto it (default 0, exact only)")
+    parser.add_argument("--snap", choices = SNAP_POLICIES, default = "first",
+            help = "value kept when rows snap to the same slot: first row, nearest row or mean "
+            "(default first)")
+    parser.add_argument("--qa", action = "store_true",
+            help = "run range, spike and flatline checks and write a <column>_qa flag column per "
+            "parameter to the .csv and bundle")
+    parser.add_argument("--station", metavar = "NUMBER",
+            help = "only use AQUARIUS files whose header names this station - ex. 03254520")
+    parser.add_argument("--scan", metavar = "LOC",
+            help = "read only the headers of the AQUARIUS files in LOC and print their station, "
+            "parameter, units, span and rows with duplicates and conflicts flagged")
+    parser.add_argument("--catalog", metavar = "FILE",
+            help = "with --scan, also write the catalog as a .csv file")
+    parser.add_argument("--watch", metavar = "ROOT",
+            help = "keep running and rebuild the station-years of new or changed AQUARIUS files "
+            "under ROOT, routed by the station in their header")
+    parser.add_argument("--out-dir", default = ".", metavar = "DIR",
+            help = "where --watch writes <station>_<water year>.csv (default .)")
+    parser.add_argument("--poll", type = float, default = 2.0, metavar = "SECONDS",
+            help = "seconds between scans of the --watch directory (default 2)")
+    parser.add_argument("--settle", type = float, default = 5.0, metavar = "SECONDS",
+            help = "seconds without changes before --watch rebuilds (default 5)")
+    parser.add_argument("--once", action = "store_true",
+            help = "with --watch, build missing or outdated station-years and exit")
+    parser.add_argument("--memory-cache", type = float, default = 512, metavar = "MB",
+            help = "parsed files --watch keeps in memory between rebuilds (default 512)")
+    parser.add_argument("--serve", nargs = "+", metavar = "DIR",
+            help = "answer time range queries over the SD1 outputs and bundles under DIR on a "
+            "local HTTP service")
+    parser.add_argument("--host", default = "127.0.0.1",
+            help = "address --serve listens on (default 127.0.0.1, this machine only)")
+    parser.add_argument("--port", type = int, default = 8651,
+            help = "port --serve listens on (default 8651)")
+    parser.add_argument("--max-loaded", type = int, default = 64, metavar = "N",
+            help = "station-years --serve keeps loaded at once (default 64)")
+    parser.add_argument("--update", action = "store_true",
+            help = "update an existing output from new or changed AQUARIUS files only")
+    parser.add_argument("--profile", nargs = "?", const = "table", choices = ("table", "json"),
+            help = "report time, rows and memory growth of each stage as a table (default) or json")
+    parser.add_argument("--profile-out", metavar = "FILE",
+            help = "write the --profile report to FILE instead of printing it")
+    parser.add_argument("--cprofile", metavar = "FILE",
+            help = "run under cProfile, save the statistics to FILE and print the top functions")
+    parser.add_argument("--tracemalloc", action = "store_true",
+            help = "trace Python allocations so stage peaks and top allocation sites are reported")
+    parser.add_argument("--no-cache", action = "store_true",
+            help = "parse every AQUARIUS file without using the parsed file cache")
+    parser.add_argument("--rebuild-cache", action = "store_true",
+            help = "parse every AQUARIUS file again and replace its cache entry")
+    parser.add_argument("--cache-dir", default = DEFAULT_CACHE_DIR, metavar = "DIR",
+            help = "location of the parsed file cache (default " + DEFAULT_CACHE_DIR + ")")
+    parser.add_argument("--cache-size", type = float, default = DEFAULT_CACHE_MB, metavar = "MB",
+            help = "size above which least recently used cache entries are removed (default "
+            + str(DEFAULT_CACHE_MB) + ")")
+
+    args = parser.parse_args(argv)
+    if args.batch is None and args.watch is None and args.serve is None and args.scan is None \
+            and args.out is None:
+        parser.error("water year, location and output file are required without --batch, "
+                "--watch, --serve or --scan")
+    if args.interval < 1 or args.tolerance < 0:
+        parser.error("--interval must be at least 1 and --tolerance not negative")
+    if isinstance(args.wtr_yr, tuple) and (args.update or args.binary or args.qa):
+        parser.error("--update, --binary and --qa need a water year rather than a time range")
+    if args.window < 1:
+        parser.error("--window must be at least 1 month")
+
+    return args
+
+
+def run(args):
 
-
-
-def writetocsv(gage_dict, data_dict, time_dict, path):
-    """
-    Writes all data manipulated to a final .csv file. Required arguments include the updated gage_dict
-    with updated parameter data, a single parameter data_dict(any) to populate the station information,
-    the time_dict created in the time_cols function, and a filepath to the desired output file.
     """
-    with open(path, 'w', newline = "\n") as f:
-        
-        writer = csv.writer(f)
-        
-        ## Header row per SD1 example
-        writer.writerow(["station_num","station_name","station","Date","Time"," Mins","DT", "DT2",
-        "gageheight_ft","discharge_cfs","precip_in", "temp_c", "do_mgL", " pH_su", "conductance_umhos",
-        "turb_ntu", "Velocity", "Nitrate"] )
-        
-        ## Writing data to file
-        for i in range(len(gage_dict["dt_range"])):
-
-            writer.writerow([data_dict["station"], data_dict["name"], data_dict["name"].split(" ")[0],
-                    time_dict["date"][i], time_dict["time"][i], time_dict["mins"][i],
-                    gage_dict["dt_range"][i], "", gage_dict["gageheight_ft"][i], 
-                    gage_dict["discharge_cfs"][i], gage_dict["precip_in"][i], 
-                    gage_dict["temp_c"][i], gage_dict["do_mgL"][i], gage_dict["pH_su"][i],
-                    gage_dict["cond_umhos"][i], gage_dict["turb_ntu"][i],
-                    gage_dict["velocity_ft_s"][i], gage_dict["nitrate_mgL"][i]])
-
-
-
-def plot(gage_dict):
+    Runs the single station, update, batch, watch, serve or scan job described by the command
+    line arguments.
     """
-    Plots for each parameter
-    """
-    ## Create a directory for figures if not already existing
-    if not "figs" in os.listdir("."):
-        os.mkdir("figs")
-
-    params = ["gageheight_ft", "discharge_cfs", "precip_in", "temp_c", "do_mgL", "pH_su",
-            "cond_umhos", "turb_ntu", "velocity_ft_s", "nitrate_mgL"]
-
-    y_labels = ["Gage height (ft)", "Discharge (cfs)", "Precipitation (in)", "Temperature (deg C)",
-            "Dissolved Oxygen (mg/L)", "pH", "Specific Conductance @ 25 deg C (uS/cm)",
-            "Turbidity (FNU)", "Velocity (ft/s)", "Nitrate (mg/L)"]
-
-    for param in params:
-        for key in gage_dict:
-            ## Matching dict key to appropriate y axis label
-            for i in range(len(params)):
-                if param == params[i]:
-                    y_label = y_labels[i] 
-            if param == key:
-                try:
-                
-                    fig = plt.figure()
-                    ax = fig.add_subplot(111)
-                    ax.plot(gage_dict["dt_range"], gage_dict[param])
-                    plt.xlabel('Date' )
-                    ## Rotating x axis labels
-                    plt.xticks( rotation = 45)
-                    ## Gridlines on
-                    ax.grid(True)
-                    ## Text to include summary stats
-                    ## transform = ax.transAxes places text in relative location
-                    ## with (1,1) as top right corner
-                    ax.text(0.75, 0.8, "Mean: " + str(round(np.nanmean(gage_dict[param]), 2)) + 
-                        "\nMin: " + str(round(np.nanmin(gage_dict[param]),2)) + 
-                        "\nMax: " + str(round(np.nanmax(gage_dict[param]),2)), 
-                        transform = ax.transAxes, bbox = dict(fc = 'white'))
-                    plt.ylabel(y_label)
-                    fig.subplots_adjust(bottom = 0.2)
-                    fig.savefig("figs/" + param + ".png")
-                    plt.close()
-            
-                except:
-                    ## For instances where param values are entirely np.nan vals
-                    print("Unable to plot " + param)
-def main():
+    if args.scan is not None:
+        catalog = scan_headers(find_sources(args.scan), max(args.jobs, SCAN_JOBS))
+        print_catalog(catalog)
+        if args.catalog:
+            write_catalog(args.catalog, catalog)
+        return
+
+    if args.serve is not None:
+        from aquarius_serve import serve
+        serve(args.serve, args.host, args.port, args.max_loaded)
+        return
+
+    dtype = np.float32 if args.float32 else np.double
+    snap = snap_config(args.tolerance, args.snap)
+    cache = None
+    if not args.no_cache:
+        cache = cache_config(args.cache_dir, args.cache_size, args.rebuild_cache)
+
+    if args.watch is not None:
+        ## Parsed files stay in memory between rebuilds, on top of the disk cache when there is one
+        from aquarius_watch import watch
+        if cache is None:
+            cache = cache_config(None, 0, memory_mb = args.memory_cache)
+        else:
+            cache = cache_config(args.cache_dir, args.cache_size, args.rebuild_cache,
+                    args.memory_cache)
+        watch(args.watch, args.out_dir, cache, args.workers, args.poll, args.settle,
+                args.interval, args.once, {"binary" : args.binary, "plots" : not args.no_plot,
+                "dtype" : dtype, "aggregates" : args.aggregate, "snap" : snap, "qa" : args.qa})
+        return
+
+    if args.batch is not None:
+        results = run_batch(read_manifest(args.batch), args.workers, args.jobs, cache, args.binary,
+                args.update, not args.no_plot, dtype, args.aggregate, snap, args.interval, args.qa)
+        print_summary(results)
+        if any(not row[3].startswith("ok") for row in results):
+            sys.exit(1)
+        return
 
     ## First command line argument following program - water year - ex. 2017
-    wtr_yr = int(sys.argv[1])   
-    
     ## Second command line argument following program - location of data files - ex. test_data/
-    loc = sys.argv[2]
-    
-    time_dict = time_cols(full_dt_range(wtr_yr))
-    gage_data = empty_data(full_dt_range(wtr_yr))
-    
-    ## looping over list of csv files in location given in argument above
-    for param_file in glob.glob(loc + "/*.csv"):
-        data_dict = aq_reader(param_file)
-        gage_dict = fill_empties(gage_data, data_dict)
-    
-    plot(gage_dict)
-    
-    ## Writing to output csv file to SD1 specifications
     ## Third command line argument following program - name of the csv file - ex. licking_river.csv
-    writetocsv(gage_dict, data_dict, time_dict, sys.argv[3])
+    try:
+        if isinstance(args.wtr_yr, tuple):
+            from aquarius_range import process_range
+            process_range(args.wtr_yr[0], args.wtr_yr[1], args.loc, args.out, args.interval,
+                    args.window, dtype = dtype, aggregates = args.aggregate, snap = snap,
+                    station = args.station)
+        elif args.update:
+            update_station(args.wtr_yr, args.loc, args.out, args.jobs,
+                    year_grid(args.wtr_yr, args.interval), cache = cache,
+                    binary = args.binary, plots = not args.no_plot, dtype = dtype,
+                    aggregates = args.aggregate, snap = snap, station = args.station, qa = args.qa)
+        else:
+            process_station(args.wtr_yr, args.loc, args.out, args.jobs,
+                    year_grid(args.wtr_yr, args.interval), cache = cache,
+                    binary = args.binary, plots = not args.no_plot, dtype = dtype,
+                    aggregates = args.aggregate, snap = snap, station = args.station, qa = args.qa)
+    except ValueError as err:
+        sys.exit(str(err))
+
+
+def main():
+
+    args = parse_args()
+
+    ## Instrumentation is only switched on when asked for
+    records = []
+    if args.profile:
+        add_hook(records.append)
+    if args.tracemalloc:
+        tracemalloc.start()
+    profiler = None
+    if args.cprofile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    try:
+        run(args)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        if args.tracemalloc:
+            print(tracemalloc_top())
+            tracemalloc.stop()
+        if profiler is not None:
+            print(write_cprofile(profiler, args.cprofile))
+        if args.profile:
+            report = report_table(records) if args.profile == "table" else report_json(records)
+            if args.profile_out:
+                with open(args.profile_out, "w") as f:
+                    f.write(report + "\n")
+            else:
+                print(report)
     
 
 if __name__ == "__main__":
@@ -0,0 +1,382 @@
+import csv
+import gzip
+import io
+import json
+import math
+import os
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import numpy as np
+from aquarius_binary import MANIFEST, bundle_manifest, bundle_path, load_bundle, time_slice
+from aquarius_core import PARAMETERS, SD1_HEADER, SD1_PARAMS
+from aquarius_station import read_sd1
+from aquarius_watch import water_years
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8651
+
+## Station-years held loaded at once, least recently queried first out
+DEFAULT_LOADED = 64
+
+UNITS = {entry["column"] : entry["units"] for entry in PARAMETERS}
+
+
+def last_line(path):
+    """
+    Returns the last non-empty line of a text file as bytes, reading back from the end of a
+    plain file and through the whole of a gzip compressed one.
+    """
+    if path.endswith(".gz"):
+        tail = b""
+        with gzip.open(path, "rb") as f:
+            for block in iter(lambda : f.read(1 << 20), b""):
+                tail = (tail + block)[-(1 << 16):]
+        return tail.rstrip(b"\r\n").rsplit(b"\n", 1)[-1]
+
+    with open(path, "rb") as f:
+        size = f.seek(0, os.SEEK_END)
+        tail = b""
+        while size and b"\n" not in tail.rstrip(b"\r\n"):
+            step = min(size, 1 << 16)
+            size -= step
+            f.seek(size)
+            tail = f.read(step) + tail
+    return tail.rstrip(b"\r\n").rsplit(b"\n", 1)[-1]
+
+
+def output_entry(path):
+
+    """
+    Returns the catalog entry of a processed output - a binary bundle directory or an SD1 .csv
+    (or .csv.gz) from writetocsv or a range run - without loading its values, or None when path
+    is neither. Entries hold path, kind ("bundle" or "csv"), station, name, the first and last
+    times of the output as datetime64[m] under start and end, and wtr_yrs, every water year
+    from start to end.
+    """
+    if os.path.isdir(path):
+        if not os.path.exists(os.path.join(path, MANIFEST)):
+            return None
+        manifest = bundle_manifest(path)
+        if not manifest["start"]:
+            return None
+        dt = np.load(os.path.join(path, manifest["time"]), mmap_mode = "r")
+        entry = {"path" : path, "kind" : "bundle", "station" : manifest["station"],
+                "name" : manifest["name"], "start" : np.datetime64(dt[0], "m"),
+                "end" : np.datetime64(dt[-1], "m")}
+    else:
+        if not (path.endswith(".csv") or path.endswith(".csv.gz")):
+            return None
+        opener = gzip.open if path.endswith(".gz") else open
+        column = SD1_HEADER.index("DT")
+        try:
+            with opener(path, "rt", newline = "") as f:
+                reader = csv.reader(f)
+                header, row = next(reader), next(reader)
+            last = next(csv.reader([last_line(path).decode("utf-8")]))
+            start = np.datetime64(row[column], "m")
+            end = np.datetime64(last[column], "m")
+        except (OSError, UnicodeDecodeError, StopIteration, IndexError, ValueError):
+            return None
+        if header[:len(SD1_HEADER)] != SD1_HEADER:
+            return None
+        entry = {"path" : path, "kind" : "csv", "station" : row[0], "name" : row[1],
+                "start" : start, "end" : end}
+
+    first, last = water_years([entry["start"]])[0], water_years([entry["end"]])[0]
+    entry["wtr_yrs"] = list(range(first, last + 1))
+
+    return entry
+
+
+def build_catalog(roots):
+
+    """
+    Indexes the processed outputs under each root directory by station and by every water year
+    each one covers, so an output of several years is listed under all of them. A bundle is
+    used in place of the SD1 .csv it was written with, and when two outputs hold the same
+    station-year the first found keeps it. Returns {station : {wtr_yr : entry}}.
+    """
+    catalog = {}
+    for root in roots:
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            paths = [os.path.join(dirpath, name) for name in dirnames if name.endswith(".sd1")]
+            paths += [os.path.join(dirpath, name) for name in sorted(filenames)
+                    if not os.path.exists(os.path.join(bundle_path(os.path.join(dirpath, name)),
+                    MANIFEST))]
+            ## Bundles are not walked into
+            dirnames[:] = [name for name in dirnames if not name.endswith(".sd1")]
+
+            for path in paths:
+                entry = output_entry(path)
+                if entry is None:
+                    continue
+                years = catalog.setdefault(entry["station"], {})
+                for wtr_yr in entry["wtr_yrs"]:
+                    if wtr_yr in years:
+                        print("Duplicate station-year " + entry["station"] + " " + str(wtr_yr)
+                                + " in " + path + ", keeping " + years[wtr_yr]["path"])
+                        continue
+                    years[wtr_yr] = entry
+
+    return catalog
+
+
+def new_store(roots, max_loaded = DEFAULT_LOADED):
+    """
+    Returns the state shared by the query functions and the server: the catalog of the roots
+    and the station-years loaded so far, at most max_loaded of them.
+    """
+    return {"roots" : list(roots), "catalog" : build_catalog(roots), "loaded" : OrderedDict(),
+            "max_loaded" : max(1, max_loaded), "lock" : threading.Lock()}
+
+
+def load_output(entry):
+    """
+    Returns the time axis and parameter columns of a catalog entry as a gage_dict style
+    dictionary. Bundles are memory-mapped, SD1 .csv files read into memory.
+    """
+    if entry["kind"] == "bundle":
+        return load_bundle(entry["path"])
+
+    return read_sd1(entry["path"])[0]
+
+
+def loaded(store, entry):
+    """
+    Returns the loaded gage_dict of a catalog entry, loading it and removing the least
+    recently used station-year above max_loaded when it is not loaded yet.
+    """
+    path = entry["path"]
+    with store["lock"]:
+        if path in store["loaded"]:
+            store["loaded"].move_to_end(path)
+            return store["loaded"][path]
+
+    gage_dict = load_output(entry)
+    with store["lock"]:
+        store["loaded"][path] = gage_dict
+        while len(store["loaded"]) > store["max_loaded"]:
+            store["loaded"].popitem(last = False)
+
+    return gage_dict
+
+
+def query(store, station, params = None, start = None, end = None):
+
+    """
+    Returns the values of params (all when None) of a station from start up to but not including
+    end, either of which may be None or an ISO string - ex. "2018-02-01". Only the station-years
+    that overlap the range are loaded, each cut from the output listed for it, so an output of
+    several water years is read once and serves all of them. The result holds station, name, the
+    datetime64[m] time axis under "dt_range" and {param : (units, values)} under "columns", with
+    the station-years joined in time order. Raises KeyError for an unknown station and
+    ValueError for an unknown parameter.
+    """
+    years = store["catalog"].get(station)
+    if years is None:
+        raise KeyError("Unknown station " + station)
+    params = list(params or SD1_PARAMS)
+    for param in params:
+        if param not in SD1_PARAMS:
+            raise ValueError("Unknown parameter " + param)
+
+    ## Each water year is cut from the output that holds it, an output of several years is
+    ## loaded once and sliced for each of them
+    first = np.datetime64(start, "m") if start else None
+    stop = np.datetime64(end, "m") if end else None
+    times, parts, name = [], {param : [] for param in params}, years[min(years)]["name"]
+    for wtr_yr in sorted(years):
+        lo = np.datetime64(str(wtr_yr - 1) + "-10-01", "m")
+        hi = np.datetime64(str(wtr_yr) + "-10-01", "m")
+        lo = lo if first is None else max(lo, first)
+        hi = hi if stop is None else min(hi, stop)
+        if lo >= hi or years[wtr_yr]["end"] < lo or years[wtr_yr]["start"] >= hi:
+            continue
+        gage_dict = loaded(store, years[wtr_yr])
+        rows = time_slice(gage_dict["dt_range"], lo, hi)
+        times.append(gage_dict["dt_range"][rows])
+        for param in params:
+            parts[param].append(gage_dict[param][rows])
+        name = years[wtr_yr]["name"]
+
+    join = lambda arrays, dtype : np.concatenate(arrays) if arrays else np.zeros(0, dtype = dtype)
+
+    return {"station" : station, "name" : name, "dt_range" : join(times, "datetime64[m]"),
+            "columns" : {param : (UNITS[param], join(parts[param], np.double)) for param in params}}
+
+
+def time_text(dt_range):
+    """
+    Returns the times of a datetime64 array as "YYYY-mm-dd HH:MM" strings, none for an empty one.
+    """
+    if not len(dt_range):
+        return []
+
+    return np.char.replace(np.datetime_as_string(dt_range), "T", " ").tolist()
+
+
+def as_json(result):
+    """
+    Returns a query result as a JSON ready dictionary, times as "YYYY-mm-dd HH:MM" text and
+    np.nan values as null.
+    """
+    def values(array):
+        return [None if math.isnan(value) else value for value in array.astype(np.double).tolist()]
+
+    return {"station" : result["station"], "name" : result["name"],
+            "dt" : time_text(result["dt_range"]),
+            "columns" : {param : {"units" : units, "values" : values(array)}
+                for param, (units, array) in result["columns"].items()}}
+
+
+def as_csv(results):
+    """
+    Returns query results as .csv text - station number, DT and one column per parameter of the
+    first result, one row per slot.
+    """
+    out = io.StringIO()
+    writer = csv.writer(out)
+    params = list(results[0]["columns"]) if results else []
+    writer.writerow(["station_num", "DT"] + params)
+    for result in results:
+        dt_text = time_text(result["dt_range"])
+        columns = [result["columns"][param][1].tolist() for param in params]
+        writer.writerows([result["station"], dt] + list(row) for dt, *row in zip(dt_text, *columns))
+
+    return out.getvalue()
+
+
+def split_values(values):
+    """
+    Returns the items of repeated and comma separated query string values
+    - ex. station=a,b&station=c
+    """
+    return [item for value in values for item in value.split(",") if item]
+
+
+def query_error(item):
+    """
+    Returns what is wrong with one item of a batch query - a message naming the field - or None
+    when it is a {"station", "params", "start", "end"} object with only station required.
+    """
+    if not isinstance(item, dict):
+        return "query must be an object"
+    if "station" not in item:
+        return "station is required"
+    if not isinstance(item["station"], str):
+        return "station must be a string"
+    params = item.get("params")
+    if params is not None and not (isinstance(params, list)
+            and all(isinstance(param, str) for param in params)):
+        return "params must be a list of strings"
+    for key in ("start", "end"):
+        if item.get(key) is not None and not isinstance(item[key], str):
+            return key + " must be a string"
+
+    return None
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+
+    """
+    Answers the query service requests:
+    GET /stations - the catalog, stations with their water years and output files
+    GET /query?station=S[,S...]&param=P[,P...]&start=T&end=T[&format=csv] - one result per station
+    POST /query with {"queries" : [{"station", "params", "start", "end"}, ...]} - batch queries
+    POST /reload - scans the roots again for new outputs and drops loaded station-years
+    """
+
+    def send(self, code, body, content_type = "application/json"):
+        data = (json.dumps(body) if content_type == "application/json" else body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def run_queries(self, queries, fmt = "json"):
+        try:
+            results = [query(self.server.store, item["station"], item.get("params"),
+                item.get("start"), item.get("end")) for item in queries]
+            if fmt == "csv":
+                body, content_type = as_csv(results), "text/csv"
+            else:
+                body, content_type = {"results" : [as_json(result) for result in results]}, \
+                        "application/json"
+        except KeyError as err:
+            return self.send(404, {"error" : err.args[0]})
+        except (ValueError, TypeError) as err:
+            return self.send(400, {"error" : str(err)})
+        except Exception as err:
+            ## A reply is always sent rather than the handler thread dying
+            return self.send(500, {"error" : str(err) or type(err).__name__})
+
+        self.send(200, body, content_type)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        args = parse_qs(url.query)
+        store = self.server.store
+
+        if url.path == "/stations":
+            return self.send(200, {station : {str(wtr_yr) : entry["path"]
+                for wtr_yr, entry in sorted(years.items())}
+                for station, years in sorted(store["catalog"].items())})
+        if url.path != "/query":
+            return self.send(404, {"error" : "Unknown path " + url.path})
+
+        stations = split_values(args.get("station", []))
+        if not stations:
+            return self.send(400, {"error" : "station is required"})
+        params = split_values(args.get("param", [])) or None
+        start, end = args.get("start", [None])[0], args.get("end", [None])[0]
+        self.run_queries([{"station" : station, "params" : params, "start" : start, "end" : end}
+            for station in stations], args.get("format", ["json"])[0])
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        store = self.server.store
+
+        if url.path == "/reload":
+            catalog = build_catalog(store["roots"])
+            with store["lock"]:
+                store["catalog"] = catalog
+                store["loaded"].clear()
+            return self.send(200, {"stations" : len(catalog)})
+        if url.path != "/query":
+            return self.send(404, {"error" : "Unknown path " + url.path})
+
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            queries = body["queries"]
+        except (ValueError, KeyError, TypeError):
+            return self.send(400, {"error" : "body must be {\"queries\" : [...]}"})
+        if not isinstance(queries, list):
+            return self.send(400, {"error" : "queries must be a list"})
+        for i, item in enumerate(queries):
+            error = query_error(item)
+            if error:
+                return self.send(400, {"error" : "query " + str(i) + " : " + error})
+        self.run_queries(queries, body.get("format", "json"))
+
+
+def serve(roots, host = DEFAULT_HOST, port = DEFAULT_PORT, max_loaded = DEFAULT_LOADED):
+
+    """
+    Runs the query service over the processed station-years under roots until interrupted.
+    It binds to host, the local machine only by default, and needs no network access.
+    """
+    server = ThreadingHTTPServer((host, port), QueryHandler)
+    server.store = new_store(roots, max_loaded)
+    print("Serving " + str(sum(len(years) for years in server.store["catalog"].values()))
+            + " station-years of " + str(len(server.store["catalog"])) + " stations on http://"
+            + host + ":" + str(server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Stopped serving")
+    finally:
+        server.server_close()
@@ -0,0 +1,118 @@
+import bz2
+import glob
+import gzip
+import lzma
+import os
+import struct
+import zipfile
+from contextlib import contextmanager
+
+## Compressed exports and the function that opens each as a decompressed binary stream
+COMPRESSED = {".gz" : gzip.open, ".bz2" : bz2.open, ".xz" : lzma.open}
+
+## Separates a zip archive from one of its members in a source name
+## - ex. licking_2018.zip::Discharge.ft^3_s.velq@03254520.20180201.csv
+MEMBER_SEP = "::"
+
+
+def is_export(name):
+    """
+    Returns True for the names of AQUARIUS exports - .csv files, plain or compressed.
+    """
+    name = name.lower()
+    return name.endswith(".csv") or any(name.endswith(".csv" + ext) for ext in COMPRESSED)
+
+
+def is_plain(source):
+    """
+    Returns True when a source is an uncompressed .csv file on disk that can be memory-mapped.
+    """
+    return MEMBER_SEP not in source and source.lower().endswith(".csv")
+
+
+def source_file(source):
+    """
+    Returns the file on disk holding a source, the archive for a zip member.
+    """
+    return source.split(MEMBER_SEP, 1)[0]
+
+
+def find_sources(loc):
+
+    """
+    Returns the AQUARIUS sources of a station directory in sorted order: .csv files, .csv.gz,
+    .csv.bz2 and .csv.xz files and the exports inside .zip archives, named archive::member.
+    loc may also be a single .zip archive. An archive that cannot be read is returned as a
+    source of its own so the error is reported when it is ingested.
+    """
+    if loc.lower().endswith(".zip") and os.path.isfile(loc):
+        files, archives = [], [loc]
+    else:
+        names = glob.glob(loc + "/*")
+        files = [name for name in names if is_export(name)]
+        archives = [name for name in names if name.lower().endswith(".zip")]
+
+    sources = list(files)
+    for archive in archives:
+        try:
+            with zipfile.ZipFile(archive) as z:
+                sources += [archive + MEMBER_SEP + info.filename for info in z.infolist()
+                        if not info.is_dir() and is_export(info.filename)]
+        except (OSError, zipfile.BadZipFile):
+            sources.append(archive)
+
+    return sorted(sources)
+
+
+@contextmanager
+def open_source(source):
+
+    """
+    Opens a source from find_sources as a binary stream. .gz, .bz2 and .xz exports are
+    decompressed and zip members read from the archive as they are consumed, without
+    temporary files.
+    """
+    if MEMBER_SEP in source:
+        archive, member = source.split(MEMBER_SEP, 1)
+        with zipfile.ZipFile(archive) as z, z.open(member) as raw:
+            opener = COMPRESSED.get(os.path.splitext(member)[1].lower())
+            if opener is None:
+                yield raw
+            else:
+                with opener(raw) as f:
+                    yield f
+        return
+
+    if source.lower().endswith(".zip"):
+        raise ValueError("Unreadable zip archive " + source)
+
+    opener = COMPRESSED.get(os.path.splitext(source)[1].lower(), open)
+    with opener(source, "rb") as f:
+        yield f
+
+
+def source_size(source):
+
+    """
+    Returns the uncompressed size in bytes of a source when it is known without decompressing
+    it - plain files, .gz files (from the size in their trailer, modulo 4 GiB) and uncompressed
+    zip members - and None otherwise.
+    """
+    try:
+        if MEMBER_SEP in source:
+            archive, member = source.split(MEMBER_SEP, 1)
+            if os.path.splitext(member)[1].lower() in COMPRESSED:
+                return None
+            with zipfile.ZipFile(archive) as z:
+                return z.getinfo(member).file_size
+
+        ext = os.path.splitext(source)[1].lower()
+        if ext == ".gz":
+            with open(source, "rb") as f:
+                f.seek(-4, os.SEEK_END)
+                return struct.unpack("<I", f.read(4))[0]
+        if ext in COMPRESSED or ext == ".zip":
+            return None
+        return os.path.getsize(source)
+    except (OSError, KeyError, zipfile.BadZipFile, struct.error):
+        return None
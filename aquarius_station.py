@@ -0,0 +1,521 @@
+import csv
+import gzip
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import numpy as np
+from aquarius_aggregate import AGGREGATE_RULES, aggregate, aggregate_path, write_aggregate
+from aquarius_binary import MANIFEST, bundle_path, load_bundle, write_bundle, write_extras
+from aquarius_catalog import plan_sources, scan_headers
+from aquarius_core import (PARAMETERS, SD1_HEADER, SD1_PARAMS, csv_line, empty_data,
+        fill_empties, ingest_files, print_header, sd1_header, station_stats, summary_path,
+        write_rows, writetocsv, year_grid)
+from aquarius_qa import flag_counts, station_flags
+from aquarius_profile import stage
+from aquarius_sources import find_sources, source_file
+from aquarius_stats import summarize, write_summary
+
+PLOT_LABELS = {entry["column"] : entry["label"] for entry in PARAMETERS}
+
+## Number of min/max bins each series is reduced to before plotting, about two per pixel
+## of the default 640 pixel wide figure
+PLOT_BINS = 1280
+
+def decimate(dt, values, bins = PLOT_BINS):
+
+    """
+    Reduces a series to the min and max of each of bins equal width bins, in that order at the
+    start time of the bin, so spikes survive at screen resolution. Bins with only np.nan values
+    stay np.nan so gaps are still drawn as gaps. Series shorter than two points per bin are
+    returned unchanged.
+    """
+    n = len(values)
+    if n <= 2 * bins:
+        return dt, values
+
+    width = -(-n // bins)
+    padded = np.full(width * (-(-n // width)), np.nan)
+    padded[:n] = values
+    padded = padded.reshape(-1, width)
+
+    ## fmin/fmax skip np.nan without the warnings nanmin/nanmax raise on empty bins
+    envelope = np.column_stack((np.fmin.reduce(padded, axis = 1), np.fmax.reduce(padded, axis = 1)))
+
+    return np.repeat(dt[::width], 2), envelope.ravel()
+
+
+def render_plots(tasks, fig_dir):
+
+    """
+    Draws and saves one figure per (param, y_label, dt, values, stats) task, reusing a single
+    Agg figure for every task. Returns the params that could not be plotted.
+    """
+    ## matplotlib is only imported once a figure is drawn, so runs without plots never load it.
+    ## Figures are drawn straight onto an Agg canvas, no pyplot backend is started.
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    failed = []
+
+    for param, y_label, dt, values, stats in tasks:
+        try:
+            fig.clf()
+            ax = fig.add_subplot(111)
+            ax.plot(dt, values)
+            ax.set_xlabel('Date' )
+            ## Rotating x axis labels
+            ax.tick_params(axis = "x", labelrotation = 45)
+            ## Gridlines on
+            ax.grid(True)
+            ## Text to include summary stats
+            ## transform = ax.transAxes places text in relative location
+            ## with (1,1) as top right corner
+            ax.text(0.75, 0.8, "Mean: " + str(round(stats["mean"], 2)) + 
+                "\nMin: " + str(round(stats["min"],2)) + 
+                "\nMax: " + str(round(stats["max"],2)), 
+                transform = ax.transAxes, bbox = dict(fc = 'white'))
+            ax.set_ylabel(y_label)
+            fig.subplots_adjust(bottom = 0.2)
+            fig.savefig(os.path.join(fig_dir, param + ".png"))
+    
+        except Exception:
+            ## For instances where param values are entirely np.nan vals
+            failed.append(param)
+
+    return failed
+
+
+def plot(gage_dict, fig_dir = "figs", jobs = 1):
+    """
+    Plots for each parameter. Series are decimated to a min/max envelope before drawing, the
+    summary stats stored by fill_empties are reused when present, and figures are rendered in
+    jobs processes when jobs is greater than 1.
+    """
+    ## Create a directory for figures if not already existing
+    os.makedirs(fig_dir, exist_ok = True)
+
+    dt = np.asarray(gage_dict["dt_range"], dtype = "datetime64[m]")
+    stats = gage_dict.get("stats", {})
+
+    tasks = []
+    for param in SD1_PARAMS:
+        if param not in gage_dict:
+            continue
+        x, y = decimate(dt, np.asarray(gage_dict[param]))
+        tasks.append((param, PLOT_LABELS[param], x, y, 
+            stats.get(param) or summarize(gage_dict[param], dt)))
+
+    if jobs <= 1 or len(tasks) <= 1:
+        failed = render_plots(tasks, fig_dir)
+    else:
+        ## Round robin split keeps the work per process even
+        chunks = [tasks[i::jobs] for i in range(min(jobs, len(tasks)))]
+        with ProcessPoolExecutor(max_workers = len(chunks)) as executor:
+            failed = sum(executor.map(render_plots, chunks, repeat(fig_dir)), [])
+
+    for param in failed:
+        print("Unable to plot " + param)
+
+
+def write_aggregates(gage_dict, data_dict, out, periods):
+    """
+    Writes the hourly, daily and/or monthly products of the gage table next to the SD1 output,
+    each parameter reduced by the "aggregate" rules of its PARAMETERS entry.
+    """
+    for period in periods:
+        with stage("aggregate", aggregate_path(out, period), len(gage_dict["dt_range"])):
+            labels, columns = aggregate(gage_dict["table"], gage_dict["dt_range"], period,
+                    AGGREGATE_RULES)
+            write_aggregate(aggregate_path(out, period), data_dict["station"], labels, columns)
+
+
+def apply_qa(gage_dict, verbose = True):
+    """
+    Runs the QA checks of every parameter, keeping the flags under gage_dict["flags"] and the
+    number of slots each check flagged in the parameter's statistics as qa_<check>.
+    """
+    with stage("qa", "flags", len(gage_dict["dt_range"])):
+        gage_dict["flags"] = station_flags(gage_dict, PARAMETERS)
+
+    for column, flags in gage_dict["flags"].items():
+        counts = flag_counts(flags)
+        gage_dict["stats"][column].update({"qa_" + name : n for name, n in counts.items()})
+        if verbose and any(counts.values()):
+            print(column + " QA flags : " + ", ".join(name + " " + str(n) 
+                for name, n in counts.items()))
+
+
+def process_station(wtr_yr, loc, out, jobs = 1, grid = None, fig_dir = "figs", verbose = True,
+        cache = None, binary = False, plots = True, dtype = np.double, aggregates = (),
+        snap = None, station = None, qa = False):
+
+    """
+    Builds the SD1 file for one station directory (or zip archive, or list of sources from
+    find_sources) and water year. grid is the (dt_range, time_dict) pair from year_grid and is
+    built here when not given, cache is the parsed file cache from cache_config or None. With
+    binary the gage table is also written as a columnar bundle next to the SD1 file, and plots
+    are skipped when plots is False. dtype is the float type of the gage table. The statistics
+    of each parameter are written to summary_path(out) and the products of each period in
+    aggregates (PERIODS keys) to aggregate_path(out, period). snap is the snap_config used to
+    place timestamps on the grid. The headers of the sources are scanned first and only the
+    sources planned by plan_sources are parsed, so when station is given only sources whose
+    header names that station are used, and ValueError is raised when sources of several
+    stations are found without it. With qa the QA flags of every parameter are written after
+    its values in the .csv and in the bundle. Returns the number of AQUARIUS sources processed
+    and raises ValueError when there are none.
+    """
+    if grid is None:
+        grid = year_grid(wtr_yr)
+    dt_range, time_dict = grid
+
+    gage_data = empty_data(dt_range, dtype)
+    gage_dict = gage_data
+    data_dict = None
+    processed = 0
+    
+    ## Files and archive members are read in parallel when jobs is given and merged in sorted
+    ## source order
+    sources = find_sources(loc) if isinstance(loc, str) else sorted(loc)
+    with stage("scan_headers", loc if isinstance(loc, str) else None, len(sources)):
+        param_files, skipped = plan_sources(scan_headers(sources), dt_range, station)
+    if verbose:
+        for path, reason in skipped:
+            print("Skipping " + path + " : " + reason)
+    for result in ingest_files(param_files, dt_range, jobs, cache, snap):
+        if "error" in result:
+            print("Unable to process " + result["path"] + " : " + result["error"])
+            continue
+        if verbose:
+            print_header(result["station"], result["name"], result["units"])
+        data_dict = result
+        with stage("fill_empties", result["path"], len(dt_range)):
+            gage_dict = fill_empties(gage_data, data_dict, verbose)
+        processed += 1
+
+    if data_dict is None:
+        raise ValueError("No AQUARIUS files processed in " 
+                + (loc if isinstance(loc, str) else ", ".join(sources)))
+
+    with stage("summary", summary_path(out), len(dt_range)):
+        gage_dict["stats"] = station_stats(gage_dict)
+    if qa:
+        apply_qa(gage_dict, verbose)
+    write_summary(summary_path(out), data_dict, wtr_yr, gage_dict["stats"])
+    
+    if plots:
+        with stage("plot", fig_dir, len(dt_range)):
+            plot(gage_dict, fig_dir, jobs)
+    
+    ## Writing to output csv file to SD1 specifications
+    with stage("writetocsv", out, len(dt_range)):
+        writetocsv(gage_dict, data_dict, time_dict, out)
+    if binary:
+        with stage("write_bundle", bundle_path(out), len(dt_range)):
+            write_bundle(gage_dict, data_dict, bundle_path(out))
+    write_aggregates(gage_dict, data_dict, out, aggregates)
+
+    return processed
+
+
+def read_sd1(path):
+    """
+    Reads the parameter columns and station information back from an SD1 .csv file written by
+    writetocsv. Returns a dictionary of parameter arrays, with the datetime64[m] time axis of
+    the DT column under "dt_range", and a data_dict with station and name.
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", newline = "") as f:
+        reader = csv.reader(f)
+        next(reader)
+        rows = [row for row in reader]
+
+    width = len(SD1_HEADER)
+    values = np.array([row[width:width + len(PARAMETERS)] for row in rows], 
+            dtype = np.double).reshape(len(rows), len(PARAMETERS))
+    columns = {param : values[:, i].copy() for i, param in enumerate(SD1_PARAMS)}
+    columns["dt_range"] = np.array([row[SD1_HEADER.index("DT")] for row in rows],
+            dtype = "datetime64[m]")
+    data_dict = {"station" : rows[0][0], "name" : rows[0][1]} if rows else None
+
+    return columns, data_dict
+
+
+def load_existing(out, dt_range, dtype = np.double):
+
+    """
+    Loads the gage table of an existing SD1 output, from its binary bundle when there is one and
+    from the .csv otherwise, into a new empty_data table of dtype, along with the quality codes
+    a bundle holds. Returns (gage_dict, data_dict), or None when there is no output for the
+    same water year to update.
+    """
+    bundle = bundle_path(out)
+    if os.path.exists(os.path.join(bundle, MANIFEST)):
+        stored = load_bundle(bundle)
+        with open(os.path.join(bundle, MANIFEST)) as f:
+            manifest = json.load(f)
+        columns = {param : np.array(stored[param]) for param in SD1_PARAMS if param in stored}
+        quality = {column : {field : (categories, np.array(codes))
+            for field, (categories, codes) in fields.items()}
+            for column, fields in stored.get("quality", {}).items()}
+        units = stored["units"]
+        data_dict = {"station" : manifest["station"], "name" : manifest["name"]}
+    elif os.path.exists(out):
+        columns, data_dict = read_sd1(out)
+        quality = {}
+        units = {}
+    else:
+        return None
+
+    if data_dict is None or any(len(columns.get(param, ())) != len(dt_range) for param in SD1_PARAMS):
+        return None
+
+    gage_dict = empty_data(dt_range, dtype)
+    for param in SD1_PARAMS:
+        gage_dict[param][:] = columns[param]
+    gage_dict["units"] = units
+    gage_dict["quality"] = quality
+
+    return gage_dict, data_dict
+
+
+def sources_path(out):
+    """
+    Returns the file recording the AQUARIUS files an SD1 output was last updated from.
+    """
+    return os.path.splitext(out)[0] + ".sources.json"
+
+
+def source_state(paths):
+    """
+    Returns the size and modification time of each source, keyed by absolute path. Zip members
+    take those of their archive.
+    """
+    state = {}
+    for path in paths:
+        stat = os.stat(source_file(path))
+        state[os.path.abspath(path)] = [stat.st_size, stat.st_mtime_ns]
+
+    return state
+
+
+def rewrite_tail(path, gage_dict, data_dict, time_dict, first):
+
+    """
+    Rewrites an SD1 .csv file from data row first to the end, leaving every byte before that
+    row untouched. Falls back to writing the whole file when it does not have one row per slot,
+    has other columns (QA flags switched on or off) or is gzip compressed.
+    """
+    if path.endswith(".gz"):
+        writetocsv(gage_dict, data_dict, time_dict, path)
+        return len(gage_dict["dt_range"])
+
+    with open(path, "rb") as f:
+        data = f.read()
+    newlines = np.flatnonzero(np.frombuffer(data, dtype = np.uint8) == ord("\n"))
+
+    n = len(gage_dict["dt_range"])
+    header = csv_line(sd1_header(gage_dict)).encode("utf-8")
+    if len(newlines) != n + 1 or data[:newlines[0] + 1] != header:
+        writetocsv(gage_dict, data_dict, time_dict, path)
+        return n
+
+    ## Header row ends at newlines[0], data row i starts after newlines[i]
+    with open(path, "r+b") as f:
+        f.seek(int(newlines[first]) + 1)
+        f.truncate()
+        write_rows(f, gage_dict, data_dict, time_dict, first, n)
+
+    return n - first
+
+
+def update_bundle(path, gage_dict, data_dict, changed, requalified = ()):
+
+    """
+    Writes the changed slots of each column into an existing binary bundle in place, or writes
+    the whole bundle when there is none yet. changed maps column names to boolean slot masks.
+    The quality codes of changed and requalified columns and the QA flags of every column are
+    written again, and flags are removed when the gage_dict has none.
+    """
+    if not os.path.exists(os.path.join(path, MANIFEST)):
+        write_bundle(gage_dict, data_dict, path)
+        return
+
+    with open(os.path.join(path, MANIFEST)) as f:
+        manifest = json.load(f)
+
+    for column, mask in changed.items():
+        stored = np.load(os.path.join(path, manifest["columns"][column]["file"]), mmap_mode = "r+")
+        stored[mask] = gage_dict[column][mask]
+        stored.flush()
+        del stored
+        manifest["columns"][column]["units"] = gage_dict["units"].get(column, "")
+
+    for column, info in manifest["columns"].items():
+        if "flags" not in gage_dict:
+            info.pop("flags", None)
+        if column in changed or column in requalified or "flags" in gage_dict:
+            info.update(write_extras(gage_dict, column, path))
+
+    tmp_path = os.path.join(path, MANIFEST + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent = 1)
+    os.replace(tmp_path, os.path.join(path, MANIFEST))
+
+
+def same_quality(quality, other):
+    """
+    Returns True when two sets of quality codes, {field : (categories, codes)} or None, are
+    the same.
+    """
+    if quality is None or other is None:
+        return quality is other
+    return set(quality) == set(other) and all(quality[field][0] == other[field][0]
+            and np.array_equal(quality[field][1], other[field][1]) for field in quality)
+
+
+def update_station(wtr_yr, loc, out, jobs = 1, grid = None, fig_dir = "figs", verbose = True,
+        cache = None, binary = False, plots = True, dtype = np.double, aggregates = (),
+        snap = None, station = None, qa = False):
+
+    """
+    Updates an existing SD1 output in place from the AQUARIUS sources in loc. Every parameter
+    with a source that is new or has changed since the last update is merged again from all of
+    its sources, as process_station merges them (unchanged ones come from the cache when there
+    is one), and replaces the stored column, so slots a corrected export no longer holds are
+    cleared. When a source has been removed every parameter is merged again. Other parameters
+    keep their stored values, and the summary statistics are computed again. Only the .csv
+    rows from the first changed slot onward and the changed slots of the binary bundle are
+    rewritten, and only changed parameters and aggregated products are written again. With qa
+    the QA flags are computed again. Switching qa on or off rewrites the whole .csv and the
+    statistics even when no source changed. Returns a dictionary with the number of changed
+    slots of each parameter, or None when there was no output to update and it was built in
+    full by process_station.
+    """
+    if grid is None:
+        grid = year_grid(wtr_yr)
+    dt_range, time_dict = grid
+
+    param_files = find_sources(loc)
+    state = source_state(param_files)
+
+    existing = load_existing(out, dt_range, dtype)
+    if existing is None:
+        if verbose:
+            print("No existing output for water year " + str(wtr_yr) + ", building " + out)
+        process_station(wtr_yr, loc, out, jobs, grid, fig_dir, verbose, cache, binary, plots, dtype,
+                aggregates, snap, station, qa)
+        with open(sources_path(out), "w") as f:
+            json.dump(state, f, indent = 1)
+        return None
+    gage_dict, data_dict = existing
+
+    try:
+        with open(sources_path(out)) as f:
+            previous = json.load(f)
+    except (OSError, ValueError):
+        previous = {}
+
+    ## Parameters with a file that is new or differs in size or modification time are merged
+    ## again from all of their files, every parameter when a file is gone
+    new_files = [path for path in param_files 
+            if previous.get(os.path.abspath(path)) != state[os.path.abspath(path)]]
+    ## Files are routed to the station of the output unless another is asked for
+    catalog = scan_headers(param_files)
+    planned, skipped = plan_sources(catalog, dt_range, station or data_dict["station"])
+    if verbose:
+        for path, reason in skipped:
+            if path in new_files:
+                print("Skipping " + path + " : " + reason)
+
+    entries = dict((entry["source"], entry) for entry in catalog)
+    if set(previous) - set(state):
+        dirty = set(SD1_PARAMS)
+    else:
+        dirty = set(entries[path].get("column") for path in new_files) - set([None])
+    reread = [path for path in planned if entries[path].get("column") in dirty
+            or ("error" in entries[path] and path in new_files)]
+
+    merged = empty_data(dt_range, dtype)
+    failed = set()
+    for result in ingest_files(reread, dt_range, jobs, cache, snap):
+        if "error" in result:
+            print("Unable to process " + result["path"] + " : " + result["error"])
+            del state[os.path.abspath(result["path"])]
+            failed.add(entries[result["path"]].get("column"))
+            continue
+        fill_empties(merged, result, False)
+
+    changed = {}
+    requalified = set()
+    ## A parameter with a file that could not be read keeps its stored values
+    for column in sorted(dirty - failed):
+        new = merged[column]
+        stored = gage_dict[column]
+        mask = (np.isnan(new) != np.isnan(stored)) | (~np.isnan(new) & (new != stored))
+        stored[mask] = new[mask]
+        changed[column] = mask
+        if column in merged.get("units", {}):
+            gage_dict["units"][column] = merged["units"][column]
+
+        ## Approval and grade can change without the value changing
+        stored_quality = gage_dict["quality"].get(column)
+        quality = merged.get("quality", {}).get(column)
+        if not same_quality(quality, stored_quality):
+            if quality is None:
+                del gage_dict["quality"][column]
+            else:
+                gage_dict["quality"][column] = quality
+            requalified.add(column)
+
+    counts = {param : int(np.count_nonzero(changed[param])) if param in changed else 0 
+            for param in SD1_PARAMS}
+    changed = {param : mask for param, mask in changed.items() if mask.any()}
+
+    if verbose:
+        print(str(len(new_files)) + " of " + str(len(param_files)) + " files new or changed")
+        for param in SD1_PARAMS:
+            print(param + " slots changed : " + str(counts[param]))
+
+    ## Switching QA flags on or off changes the columns of every row and the statistics
+    reshaped = False
+    if os.path.exists(out):
+        opener = gzip.open if out.endswith(".gz") else open
+        with opener(out, "rb") as f:
+            reshaped = f.readline() != csv_line(sd1_header({"flags" : {}} if qa else {})
+                    ).encode("utf-8")
+
+    if changed or reshaped or not os.path.exists(summary_path(out)):
+        with stage("summary", summary_path(out), len(dt_range)):
+            gage_dict["stats"] = station_stats(gage_dict)
+        if qa:
+            apply_qa(gage_dict, verbose)
+        write_summary(summary_path(out), data_dict, wtr_yr, gage_dict["stats"])
+    elif qa:
+        gage_dict["flags"] = station_flags(gage_dict, PARAMETERS)
+
+    if changed or reshaped:
+        first = int(min(np.argmax(mask) for mask in changed.values())) if changed else 0
+        with stage("rewrite_tail", out) as record:
+            rewritten = rewrite_tail(out, gage_dict, data_dict, time_dict, first)
+            record["rows"] = rewritten
+        if verbose:
+            print("Rows rewritten : " + str(rewritten))
+        if plots:
+            with stage("plot", fig_dir, len(dt_range)):
+                plot(dict([("dt_range", dt_range), ("stats", gage_dict["stats"])] 
+                    + [(param, gage_dict[param]) for param in changed]), fig_dir, jobs)
+
+    has_bundle = os.path.exists(os.path.join(bundle_path(out), MANIFEST))
+    if ((changed or requalified or reshaped) and has_bundle) or (binary and not has_bundle):
+        with stage("write_bundle", bundle_path(out)):
+            update_bundle(bundle_path(out), gage_dict, data_dict, changed, requalified)
+    write_aggregates(gage_dict, data_dict, out, [period for period in aggregates
+        if changed or not os.path.exists(aggregate_path(out, period))])
+
+    with open(sources_path(out), "w") as f:
+        json.dump(state, f, indent = 1)
+
+    return counts
@@ -0,0 +1,164 @@
+import json
+import math
+import numpy as np
+
+## Percentiles are estimated from log spaced buckets, every estimate is within this relative
+## error of a value in the bucket holding the true percentile
+PERCENTILE_ACCURACY = 0.01
+GAMMA = (1 + PERCENTILE_ACCURACY) / (1 - PERCENTILE_ACCURACY)
+LOG_GAMMA = math.log(GAMMA)
+
+PERCENTILES = (5, 50, 95)
+
+
+def new_stats():
+    """
+    Returns an empty statistics accumulator. Accumulators are plain dictionaries so they can be
+    sent back from worker processes and combined with merge_stats.
+    """
+    return {"count" : 0, "mean" : 0.0, "m2" : 0.0, "min" : None, "min_time" : None,
+            "max" : None, "max_time" : None, "zero" : 0, "positive" : {}, "negative" : {}}
+
+
+def bucket_counts(values):
+    """
+    Returns a dictionary of log bucket index to count for strictly positive values.
+    """
+    idx, counts = np.unique(np.ceil(np.log(values) / LOG_GAMMA).astype(np.int64),
+            return_counts = True)
+
+    return dict(zip(idx.tolist(), counts.tolist()))
+
+
+def update_stats(acc, timestamps, values):
+
+    """
+    Adds a chunk of values with their timestamps to an accumulator and returns the accumulator.
+    np.nan values are skipped. Chunks can be given in any size, in time order ties in the min
+    and max keep the earliest timestamp.
+    """
+    values = np.asarray(values, dtype = np.double)
+    present = ~np.isnan(values)
+    v = values[present]
+    if not len(v):
+        return acc
+    t = np.asarray(timestamps)[present]
+
+    lo, hi = int(np.argmin(v)), int(np.argmax(v))
+    mean = float(v.mean())
+    part = {"count" : len(v), "mean" : mean, "m2" : float(((v - mean) ** 2).sum()),
+            "min" : float(v[lo]), "min_time" : str(t[lo]), "max" : float(v[hi]),
+            "max_time" : str(t[hi]), "zero" : int(np.count_nonzero(v == 0)),
+            "positive" : bucket_counts(v[v > 0]), "negative" : bucket_counts(-v[v < 0])}
+
+    return merge_stats(acc, part)
+
+
+def merge_stats(a, b):
+
+    """
+    Combines two accumulators into a new one as if every value had been added to one of them.
+    Mean and variance are combined with the parallel form of Welford's algorithm, the percentile
+    buckets by adding counts. When a and b tie on min or max, a's timestamp is kept.
+    """
+    if not b["count"]:
+        return dict(a)
+    if not a["count"]:
+        return dict(b)
+
+    count = a["count"] + b["count"]
+    delta = b["mean"] - a["mean"]
+    merged = {"count" : count, "mean" : a["mean"] + delta * b["count"] / count,
+            "m2" : a["m2"] + b["m2"] + delta * delta * a["count"] * b["count"] / count,
+            "zero" : a["zero"] + b["zero"]}
+
+    for key, better in (("min", lambda x, y : y < x), ("max", lambda x, y : y > x)):
+        use_b = better(a[key], b[key])
+        merged[key] = b[key] if use_b else a[key]
+        merged[key + "_time"] = b[key + "_time"] if use_b else a[key + "_time"]
+
+    for key in ("positive", "negative"):
+        buckets = dict(a[key])
+        for idx, n in b[key].items():
+            buckets[idx] = buckets.get(idx, 0) + n
+        merged[key] = buckets
+
+    return merged
+
+
+def percentile(acc, q):
+    """
+    Returns the approximate q-th percentile (0 to 100) of the values in an accumulator.
+    """
+    count = acc["count"]
+    if not count:
+        return float("nan")
+
+    ## Buckets in ascending order of value, negatives first
+    ordered = [(-2 * GAMMA ** idx / (GAMMA + 1), acc["negative"][idx])
+            for idx in sorted(acc["negative"], reverse = True)]
+    ordered.append((0.0, acc["zero"]))
+    ordered += [(2 * GAMMA ** idx / (GAMMA + 1), acc["positive"][idx])
+            for idx in sorted(acc["positive"])]
+
+    rank = q / 100.0 * (count - 1)
+    seen = 0
+    for value, n in ordered:
+        seen += n
+        if seen > rank:
+            return min(max(value, acc["min"]), acc["max"])
+
+    return acc["max"]
+
+
+def finish_stats(acc, slots):
+
+    """
+    Returns the summary of an accumulator: count, coverage_pct of the slots in the time range,
+    mean, std, min and max with their timestamps, and p5, p50 and p95. Values are np.nan when
+    no values were added.
+    """
+    count = acc["count"]
+    nan = float("nan")
+    summary = {"count" : count, "coverage_pct" : 100.0 * count / slots if slots else 0.0,
+            "mean" : np.float64(acc["mean"]) if count else np.float64(nan),
+            "std" : math.sqrt(acc["m2"] / count) if count else nan,
+            "min" : np.float64(acc["min"]) if count else np.float64(nan),
+            "min_time" : acc["min_time"],
+            "max" : np.float64(acc["max"]) if count else np.float64(nan),
+            "max_time" : acc["max_time"]}
+    for q in PERCENTILES:
+        summary["p" + str(q)] = percentile(acc, q)
+
+    return summary
+
+
+def summarize(values, dt_range):
+    """
+    Returns finish_stats of a whole aligned series in one call.
+    """
+    return finish_stats(update_stats(new_stats(), dt_range, values), len(values))
+
+
+def write_summary(path, data_dict, wtr_yr, stats, span = None):
+
+    """
+    Writes the summary of each parameter of a station-year as JSON. stats maps columns to the
+    dictionaries returned by finish_stats; np.nan values are written as null. For a time range
+    rather than a water year, wtr_yr is None and span holds its (start, end) text.
+    """
+    def clean(value):
+        if isinstance(value, (float, np.floating)):
+            return None if math.isnan(value) else float(value)
+        return value
+
+    summary = {"station" : data_dict["station"], "name" : data_dict["name"],
+            "water_year" : wtr_yr,
+            "parameters" : {column : {key : clean(value) for key, value in item.items()}
+                for column, item in stats.items()}}
+
+    if span is not None:
+        summary["start"], summary["end"] = span
+
+    with open(path, "w") as f:
+        json.dump(summary, f, indent = 1)
@@ -0,0 +1,197 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from aquarius_cache import cache_lookup, cache_store
+from aquarius_core import read_source, source_header, year_grid
+from aquarius_sources import find_sources, source_file
+from aquarius_station import process_station
+
+## Seconds between scans of the watched directory and seconds without any change before a
+## burst of writes is processed
+POLL_SECONDS = 2.0
+SETTLE_SECONDS = 5.0
+
+
+def scan(root):
+    """
+    Returns the size and modification time of every AQUARIUS source under root, in any depth of
+    station directories, keyed by absolute path. Zip members take those of their archive.
+    Sources removed while scanning are left out.
+    """
+    state = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for source in find_sources(dirpath):
+            try:
+                stat = os.stat(source_file(source))
+            except OSError:
+                continue
+            state[os.path.abspath(source)] = (stat.st_size, stat.st_mtime_ns)
+
+    return state
+
+
+def water_years(timestamps, tolerance = 0):
+    """
+    Returns the sorted water years (10/1 - 9/30) covered by an array of datetime64 timestamps,
+    including those a timestamp within tolerance seconds of a year boundary snaps into.
+    """
+    timestamps = np.asarray(timestamps, dtype = "datetime64[s]")
+    years = set()
+    for shift in sorted(set((-tolerance, 0, tolerance))):
+        months = (timestamps + np.timedelta64(shift, "s")).astype("datetime64[M]").astype(np.int64)
+        years.update(np.unique(months // 12 + 1970 + (months % 12 >= 9)).tolist())
+
+    return sorted(years)
+
+
+def output_path(out_dir, station, wtr_yr):
+    """
+    Returns the SD1 file of a station-year built by watch - ex. out/03254520_2018.csv
+    """
+    return os.path.join(out_dir, station + "_" + str(wtr_yr) + ".csv")
+
+
+def index_source(source, cache, tolerance = 0):
+
+    """
+    Routes a source to its station by the @<station> of its header and returns (station, water
+    years) of its rows, or None when it cannot be read. The parsed rows are kept in the cache so
+    the rebuild that follows does not read the file again.
+    """
+    try:
+        station = source_header(source)["station"]
+        data_dict = cache_lookup(cache, source) if cache is not None else None
+        if data_dict is None:
+            data_dict = read_source(source, verbose = False)
+            if cache is not None:
+                cache_store(cache, source, data_dict)
+    except Exception as err:
+        print("Unable to index " + source + " : " + (str(err) or type(err).__name__))
+        return None
+
+    return station, water_years(data_dict["timestamps"], tolerance)
+
+
+def stale(index, out_dir, seen):
+    """
+    Returns the station-years whose output is missing or older than one of their sources.
+    """
+    newest = {}
+    for source, (station, years) in index.items():
+        for wtr_yr in years:
+            key = (station, wtr_yr)
+            newest[key] = max(newest.get(key, 0), seen[source][1])
+
+    stale_keys = set()
+    for key, mtime in newest.items():
+        try:
+            if os.stat(output_path(out_dir, *key)).st_mtime_ns >= mtime:
+                continue
+        except OSError:
+            pass
+        stale_keys.add(key)
+
+    return stale_keys
+
+
+def rebuild(jobs, index, out_dir, cache, workers = 1, interval = 15, options = None):
+
+    """
+    Builds the SD1 file of every (station, water year) in jobs from the sources in index routed
+    to that station and covering that year, in a pool of at most workers threads. Time grids
+    come from year_grid and parsed rows from the in-memory cache, so both stay warm between
+    rebuilds. options are passed on to process_station. Returns a list of (station, wtr_yr,
+    out, status, seconds) rows in station-year order.
+    """
+    options = options or {}
+
+    def run_job(job):
+        station, wtr_yr = job
+        out = output_path(out_dir, station, wtr_yr)
+        sources = [source for source, (found, years) in index.items()
+                if found == station and wtr_yr in years]
+        start = time.perf_counter()
+        try:
+            if not sources:
+                status = "no sources left, kept"
+            else:
+                processed = process_station(wtr_yr, sources, out, 1, year_grid(wtr_yr, interval),
+                        os.path.splitext(out)[0] + "_figs", False, cache, **options)
+                status = "ok (" + str(processed) + " files)"
+        except Exception as err:
+            status = "failed: " + (str(err) or type(err).__name__)
+        seconds = time.perf_counter() - start
+        print(station + " " + str(wtr_yr) + " -> " + out + " : " + status + " %.2fs" % seconds)
+        return (station, wtr_yr, out, status, seconds)
+
+    jobs = sorted(jobs)
+    if not jobs:
+        return []
+    with ThreadPoolExecutor(max_workers = max(1, min(workers, len(jobs)))) as executor:
+        return list(executor.map(run_job, jobs))
+
+
+def watch(root, out_dir, cache, workers = 1, poll = POLL_SECONDS, settle = SETTLE_SECONDS,
+        interval = 15, once = False, options = None):
+
+    """
+    Watches root for new, changed and removed AQUARIUS sources and rebuilds the SD1 file of each
+    affected station-year in out_dir. root is scanned every poll seconds and changes are
+    processed once nothing has changed for settle seconds, so a burst of writes leads to one
+    rebuild. Sources are routed by the station in their header rather than by directory. On
+    start every station-year whose output is missing or older than its sources is built; with
+    once watch returns after that. cache should keep parsed rows in memory (cache_config with
+    memory_mb) so unchanged sources are not parsed again. options are passed on to
+    process_station. Runs until interrupted.
+    """
+    os.makedirs(out_dir, exist_ok = True)
+    snap = (options or {}).get("snap")
+    tolerance = snap["tolerance"] if snap else 0
+
+    seen = scan(root)
+    index = {}
+    for source in seen:
+        routed = index_source(source, cache, tolerance)
+        if routed is not None:
+            index[source] = routed
+    print("Watching " + root + " : " + str(len(index)) + " sources, "
+            + str(len(set(station for station, years in index.values()))) + " stations")
+    rebuild(stale(index, out_dir, seen), index, out_dir, cache, workers, interval, options)
+    if once:
+        return
+
+    pending = set()
+    last_change = time.monotonic()
+    try:
+        while True:
+            time.sleep(poll)
+            current = scan(root)
+            changed = set(source for source in current if seen.get(source) != current[source])
+            changed |= set(seen) - set(current)
+            seen = current
+            if changed:
+                pending |= changed
+                last_change = time.monotonic()
+                continue
+            if not pending or time.monotonic() - last_change < settle:
+                continue
+
+            ## Both the station-years a source covered and those it covers now are rebuilt
+            jobs = set()
+            for source in sorted(pending):
+                old = index.pop(source, None)
+                if old is not None:
+                    jobs.update((old[0], wtr_yr) for wtr_yr in old[1])
+                if source in seen:
+                    routed = index_source(source, cache, tolerance)
+                    if routed is not None:
+                        index[source] = routed
+                        jobs.update((routed[0], wtr_yr) for wtr_yr in routed[1])
+            print(str(len(pending)) + " sources changed, rebuilding " + str(len(jobs))
+                    + " station-years")
+            pending = set()
+            rebuild(jobs, index, out_dir, cache, workers, interval, options)
+    except KeyboardInterrupt:
+        print("Stopped watching " + root)
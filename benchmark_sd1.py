@@ -0,0 +1,303 @@
+"""
+Benchmarks each stage of the SD1 pipeline on synthetic AQUARIUS files and writes the results
+as JSON so runs of different versions can be compared.
+
+    python benchmark_sd1.py --sizes 1yr-15min 1yr-1min --output bench.json
+    python benchmark_sd1.py --compare bench.json
+"""
+from datetime import datetime
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import aquarius_core as core
+import aquarius_station as station
+
+## name, (years of data, interval in minutes)
+SIZES = {"1yr-15min" : (1, 15), "10yr-15min" : (10, 15), "1yr-5min" : (1, 5),
+        "1yr-1min" : (1, 1), "5yr-1min" : (5, 1), "20yr-1min" : (20, 1)}
+DEFAULT_SIZES = ["1yr-15min", "10yr-15min", "1yr-1min"]
+
+## Value parameter, units, file name stem and (low, high) of the synthetic values
+PARAMS = {"Discharge" : ("ft^3/s", "Discharge.ft^3_s.velq", (300.0, 60000.0)),
+        "Gage height" : ("ft", "Gage_height.ft.Radar", (2.0, 40.0)),
+        "Precipitation" : ("in", "Precipitation.in.Work", (0.0, 0.5)),
+        "Temperature, water" : ("degC", "Temperature,_water.degC", (0.0, 32.0)),
+        "Dissolved oxygen" : ("mg/l", "Dissolved_oxygen.mg_l", (5.0, 14.0)),
+        "pH" : ("pH Units", "pH.pH_Units", (6.5, 9.0)),
+        "Specific cond at 25C" : ("uS/cm", "Specific_cond_at_25C.uS_cm", (100.0, 600.0)),
+        "Turbidity, FNU" : ("_FNU", "Turbidity,_FNU._FNU", (1.0, 3000.0)),
+        "Mean water velocity" : ("ft/s", "Mean_water_velocity.ft_s", (0.0, 16.0)),
+        "NO3+NO2,water,insitu as N" : ("mg/l", "NO3+NO2,water,insitu_as_N.mg_l", (0.0, 3.0))}
+
+STATION = "03254520"
+LOCATION = "LICKING RIVER AT HWY 536 NEAR ALEXANDRIA, KY"
+
+## Rows generated per block so multi-decade files never sit in memory as text
+BLOCK_ROWS = 1000000
+
+
+def aq_header(param, units, stem, start, end):
+    """
+    Returns the 15 header lines of an AQUARIUS export, CSV column names included.
+    """
+    ident = param + "." + units + "@" + STATION
+    return ["# " + stem + "@" + STATION + "." + start.strftime("%Y%m%d") + ".csv generated at "
+            + datetime.now().strftime("%Y-%m-%d %H:%M:%S") + " (UTC+00:00) by AQUARIUS 18.1.204.0\n",
+            "# \n",
+            "# Time series identifier: " + ident + "\n",
+            "# Location: " + LOCATION + "\n",
+            "# UTC offset: (UTC-05:00)\n",
+            "# Value units: " + units + "\n",
+            "# Value parameter: " + param + "\n",
+            "# Interpolation type: Instantaneous Values\n",
+            "# Time series type: Basic\n",
+            "# \n",
+            "# Export options: Corrected signal from " + start.strftime("%Y-%m-%dT%H:%M:%SZ")
+            + " to " + end.strftime("%Y-%m-%dT%H:%M:%SZ") + "\n",
+            "# \n",
+            "# CSV data starts at line 15.\n",
+            "# \n",
+            "ISO 8601 UTC, Timestamp (UTC-05:00), Value, Approval Level, Grade, Qualifiers\n"]
+
+
+def write_aq_file(path, param, start, rows, interval = 15, gaps = 0, gap_rows = 96, seed = 0):
+
+    """
+    Writes a synthetic AQUARIUS export of rows values every interval minutes from start (a
+    datetime). gaps blocks of gap_rows rows each are left out at random. Returns the number of
+    rows written.
+    """
+    units, stem, (low, high) = PARAMS[param]
+    rng = np.random.default_rng(seed)
+
+    keep = np.ones(rows, dtype = bool)
+    for gap_start in rng.integers(0, max(rows - gap_rows, 1), size = gaps):
+        keep[gap_start:gap_start + gap_rows] = False
+
+    step = np.timedelta64(interval, "m")
+    first = np.datetime64(start, "m")
+    utc = np.timedelta64(5, "h")
+
+    with open(path, "w", newline = "\n") as f:
+        f.writelines(aq_header(param, units, stem, start,
+            (first + step * max(rows - 1, 0)).astype(datetime)))
+
+        for block in range(0, rows, BLOCK_ROWS):
+            idx = np.arange(block, min(block + BLOCK_ROWS, rows))
+            idx = idx[keep[idx]]
+            local = first + step * idx
+            values = low + (high - low) * (0.5 + 0.5 * np.sin(idx / 500.0)) * rng.random(len(idx))
+            local_text = np.datetime_as_string(local, unit = "s")
+            utc_text = np.datetime_as_string(local + utc, unit = "s")
+            f.write("".join(u + "Z," + t.replace("T", " ") + "," + repr(round(v, 4))
+                + ",Working,50,\n" for u, t, v in zip(utc_text.tolist(), local_text.tolist(),
+                    values.tolist())))
+
+    return int(keep.sum())
+
+
+def write_station(loc, wtr_yr, years = 1, interval = 15, params = None, gaps = 0, seed = 0):
+    """
+    Writes one synthetic AQUARIUS file per parameter into loc covering the years water years
+    that end with wtr_yr. Returns a list of (path, rows) pairs.
+    """
+    os.makedirs(loc, exist_ok = True)
+    start = datetime(wtr_yr - years, 10, 1)
+    rows = int((np.datetime64(datetime(wtr_yr, 10, 1), "m") - np.datetime64(start, "m"))
+            // np.timedelta64(interval, "m"))
+
+    files = []
+    for i, param in enumerate(params or PARAMS):
+        path = os.path.join(loc, PARAMS[param][1] + "@" + STATION + "."
+                + start.strftime("%Y%m%d") + ".csv")
+        files.append((path, write_aq_file(path, param, start, rows, interval, gaps, seed = seed + i)))
+
+    return files
+
+
+def span_grid(wtr_yr, years = 1, interval = 15):
+    """
+    Returns the datetime64[m] grid of interval minutes over the years water years that end with
+    wtr_yr, the span write_station writes, as a time range run builds it.
+    """
+    return np.arange(np.datetime64(str(wtr_yr - years) + "-10-01T00:00"),
+            np.datetime64(str(wtr_yr) + "-10-01T00:00"), np.timedelta64(interval, "m"))
+
+
+def timed(func, *args, repeat = 1):
+    """
+    Returns the result of func(*args) and the best wall time in seconds of repeat calls.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return result, best
+
+
+def bench_size(size, work_dir, wtr_yr = 2018, params = None, gaps = 0, repeat = 1):
+
+    """
+    Times every pipeline stage on synthetic files of one size. The grid covers the whole span
+    and interval of the files, so every stage scales with the size. Returns a list of result
+    rows.
+    """
+    years, interval = SIZES[size]
+    loc = os.path.join(work_dir, size)
+    files = write_station(loc, wtr_yr, years, interval, params, gaps)
+    total_rows = sum(rows for path, rows in files)
+    results = []
+
+    def record(stage, rows, seconds):
+        results.append({"size" : size, "stage" : stage, "rows" : rows, "seconds" : seconds,
+            "rows_per_second" : rows / seconds if seconds else None})
+        print("%-11s %-14s %12d rows %9.4f s" % (size, stage, rows, seconds))
+
+    dt_range, seconds = timed(span_grid, wtr_yr, years, interval, repeat = repeat)
+    record("time_grid", len(dt_range), seconds)
+    time_dict, seconds = timed(core.time_cols, dt_range, repeat = repeat)
+    record("time_cols", len(dt_range), seconds)
+
+    data_dicts = []
+    seconds = 0.0
+    for path, rows in files:
+        data_dict, elapsed = timed(core.aq_reader, path, False, repeat = repeat)
+        data_dicts.append(data_dict)
+        seconds += elapsed
+    record("aq_reader", total_rows, seconds)
+
+    seconds = 0.0
+    for path, rows in files:
+        seconds += timed(core.aq_reader, path, False, True, repeat = repeat)[1]
+    record("aq_reader_mmap", total_rows, seconds)
+
+    seconds = 0.0
+    gage_dict = core.empty_data(dt_range)
+    for data_dict in data_dicts:
+        gage_dict, elapsed = timed(core.fill_empties, gage_dict, data_dict, False, repeat = repeat)
+        seconds += elapsed
+    record("fill_empties", total_rows, seconds)
+
+    out = os.path.join(work_dir, size + ".csv")
+    _, seconds = timed(core.writetocsv, gage_dict, data_dicts[-1], time_dict, out, repeat = repeat)
+    record("writetocsv", len(dt_range), seconds)
+
+    _, seconds = timed(station.plot, gage_dict, os.path.join(work_dir, size + "_figs"), repeat = repeat)
+    record("plot", len(dt_range) * len(files), seconds)
+
+    shutil.rmtree(loc, ignore_errors = True)
+
+    return results
+
+
+def import_seconds(module, repeat = 1):
+    """
+    Returns the best wall time in seconds of starting a fresh interpreter that imports module,
+    less the time of one that imports nothing.
+    """
+    def start(code):
+        return timed(subprocess.run, [sys.executable, "-c", code],
+                repeat = max(repeat, 3))[1]
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    return max(start("import sys; sys.path.insert(0, %r); import %s" % (here, module))
+            - start("pass"), 0.0)
+
+
+def bench_startup(repeat = 1):
+    """
+    Times the import of the headless core and of the command line module. Returns a list of
+    result rows.
+    """
+    results = []
+    for module in ("aquarius_core", "aquarius_sd1"):
+        seconds = import_seconds(module, repeat)
+        results.append({"size" : "startup", "stage" : "import " + module, "rows" : 0,
+            "seconds" : seconds, "rows_per_second" : None})
+        print("%-11s %-14s %17s %9.4f s" % ("startup", module, "", seconds))
+
+    return results
+
+
+def git_version():
+    """
+    Returns the git description of the working tree, or None outside a git checkout.
+    """
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output = True,
+                text = True, cwd = os.path.dirname(os.path.abspath(__file__)),
+                check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold = 1.2):
+    """
+    Prints the time ratio of each stage against a previous results file. Returns the stages that
+    got slower than threshold times the baseline.
+    """
+    before = {(row["size"], row["stage"]) : row["seconds"] for row in baseline["results"]}
+    slower = []
+    for row in results:
+        key = (row["size"], row["stage"])
+        if key not in before or not before[key]:
+            continue
+        ratio = row["seconds"] / before[key]
+        flag = " SLOWER" if ratio > threshold else ""
+        print("%-11s %-14s %7.2fx%s" % (key + (ratio, flag)))
+        if ratio > threshold:
+            slower.append(key)
+
+    return slower
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description = "Benchmark the SD1 pipeline on synthetic data")
+    parser.add_argument("--sizes", nargs = "+", choices = sorted(SIZES), default = DEFAULT_SIZES,
+            help = "data sizes to run (default " + " ".join(DEFAULT_SIZES) + ")")
+    parser.add_argument("--params", nargs = "+", choices = sorted(PARAMS), metavar = "PARAM",
+            help = "parameter files to generate (default all ten)")
+    parser.add_argument("--gaps", type = int, default = 0, help = "gaps of 96 rows left out per file")
+    parser.add_argument("--repeat", type = int, default = 1, help = "runs of each stage, best is kept")
+    parser.add_argument("--output", default = "bench.json", help = "results file (default bench.json)")
+    parser.add_argument("--compare", metavar = "JSON", help = "earlier results file to compare against")
+    parser.add_argument("--threshold", type = float, default = 1.2,
+            help = "slowdown ratio reported as a regression (default 1.2)")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix = "sd1_bench_")
+    results = bench_startup(args.repeat)
+    try:
+        for size in args.sizes:
+            results += bench_size(size, work_dir, params = args.params, gaps = args.gaps,
+                    repeat = args.repeat)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors = True)
+
+    report = {"version" : git_version(), "date" : datetime.now().isoformat(timespec = "seconds"),
+            "python" : platform.python_version(), "numpy" : np.__version__,
+            "machine" : platform.machine(), "results" : results}
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent = 1)
+    print("Results written to " + args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            slower = compare(results, json.load(f), args.threshold)
+        if slower:
+            sys.exit(str(len(slower)) + " stages slower than " + str(args.threshold) + "x")
+
+
+if __name__ == "__main__":
+    main()
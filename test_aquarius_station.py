@@ -0,0 +1,52 @@
+import os
+import shutil
+from aquarius_core import summary_path
+from aquarius_station import process_station, update_station
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "licking_data")
+
+
+def test_update_switches_qa_on(tmp_path):
+    """
+    Updating an unchanged output with qa adds the flag columns and QA counts, giving the same
+    .csv as a full build with qa.
+    """
+    out = str(tmp_path / "licking_river.csv")
+    fig_dir = str(tmp_path / "figs")
+    update_station(2018, DATA, out, fig_dir = fig_dir, verbose = False)
+
+    counts = update_station(2018, DATA, out, fig_dir = fig_dir, verbose = False, qa = True)
+    assert not any(counts.values())
+
+    full = str(tmp_path / "full.csv")
+    process_station(2018, DATA, full, fig_dir = fig_dir, verbose = False, plots = False, qa = True)
+    with open(out, "rb") as f, open(full, "rb") as g:
+        assert f.read() == g.read()
+    with open(summary_path(out)) as f:
+        assert "qa_" in f.read()
+
+
+def test_update_clears_removed_rows(tmp_path):
+    """
+    Updating from a corrected export that drops rows gives the same .csv as a full build.
+    """
+    loc = str(tmp_path / "data")
+    shutil.copytree(DATA, loc)
+    out = str(tmp_path / "licking_river.csv")
+    fig_dir = str(tmp_path / "figs")
+    update_station(2018, loc, out, fig_dir = fig_dir, verbose = False, plots = False)
+
+    path = [os.path.join(loc, name) for name in os.listdir(loc) if name.startswith("Discharge")][0]
+    with open(path) as f:
+        lines = f.readlines()
+    first = max(i for i, line in enumerate(lines) if line.startswith("#")) + 2
+    with open(path, "w") as f:
+        f.writelines(lines[:first + 100] + lines[first + 2000:])
+
+    counts = update_station(2018, loc, out, fig_dir = fig_dir, verbose = False, plots = False)
+    assert counts["discharge_cfs"] == 1900
+
+    full = str(tmp_path / "full.csv")
+    process_station(2018, loc, full, fig_dir = fig_dir, verbose = False, plots = False)
+    with open(out, "rb") as f, open(full, "rb") as g:
+        assert f.read() == g.read()